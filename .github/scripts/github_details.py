@@ -2,16 +2,56 @@
 import requests
 import os
 import json
-from langchain.llms import GooglePalm
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from patch_summarizer import summarize_patch
 
-        
+# Connect and read timeout for every HTTP call, a hung request should not hold the CI job
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT_SECONDS", "30"))
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com").rstrip("/")
+SUPPORTED_EVENTS = ("PushEvent", "PullRequestEvent")
+stage_timings = {}
+# Event whose stages are being timed, so concurrent summaries in batch mode do not overwrite each other's timings
+timing_scope = contextvars.ContextVar("timing_scope", default=None)
+
+_session = None
+
+def get_session():
+        # One session for GitHub, the patch download and Google Chat so connections are reused
+        global _session
+        if _session is None:
+            _session = requests.Session()
+            # Enough pooled connections for every concurrent summary and its patch download
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(10, int(os.getenv("EVENTS_MAX_WORKERS", "4")) * 2))
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+@contextmanager
+def timed(stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            scope = timing_scope.get()
+            key = f"{scope}/{stage}" if scope else stage
+            stage_timings[key] = elapsed
+            print(f"[timing] {key}: {elapsed:.2f}s")
+
+def print_timings():
+        print("Stage timings: " + ", ".join(f"{stage}={elapsed:.2f}s" for stage, elapsed in stage_timings.items()))
 
 def get_llm():
+        # langchain is only imported once there is an event to summarise, runs with nothing to report exit early
+        from langchain.llms import GooglePalm
         return GooglePalm(temperature=0.0)
 
 def pushevent_ask(message, event_type):
+        from langchain.prompts import PromptTemplate
+        from langchain.chains import LLMChain
 
         llm = get_llm()
         print (f"Generating a natural language reponse to the GitHub Action: {event_type}\n")
@@ -34,7 +74,9 @@ def pushevent_ask(message, event_type):
         print(f"Natural language response: {response}\n")
         return response
     
-def pullrequestevent_ask(message, commit, event_type):
+def pullrequestevent_ask(message, patch_url, event_type):
+        from langchain.prompts import PromptTemplate
+        from langchain.chains import LLMChain
 
         llm = get_llm()
         event_template = '''
@@ -44,32 +86,34 @@ def pullrequestevent_ask(message, commit, event_type):
         Provide a summary to the following. Be sure to supply a URL to the pull request: {message}
         '''
         event_prompt = PromptTemplate(
-                input_variables=["message", "commit"],
+                input_variables=["message"],
                 template =event_template,
         )
-        commit_template = '''
-        You are a a helpful assistant that understands Infrastructure as Code, Python, JSON, JavaScript, and YAML. Your goal is to provide detailed descriptions over the follwing Merge Request Patch snippets of code.
-
-        Explain what changes were made in the following code snippet: {commit}
-        '''
-        commit_prompt = PromptTemplate(
-                input_variables=["commit"],
-                template =commit_template,
-        )
         print(f"Generating a natural language reponse to the GitHub Action\n")
         event_chain = LLMChain(
              llm = llm, 
              prompt = event_prompt
              )
-        commit_chain = LLMChain(
-                llm = llm, 
-                prompt = commit_prompt
-                )
-        event_response = event_chain.run({"message": message})
-        commit_response = commit_chain.run({"commit": commit})
+
+        def summarize_event():
+            with timed("event_summary"):
+                return event_chain.run({"message": message})
+
+        def summarize_commit():
+            # Streams the patch and summarises it file by file, see patch_summarizer.py
+            with timed("patch_summary"):
+                return summarize_patch(llm, get_session(), patch_url, HTTP_TIMEOUT)
+
+        # The event summary does not depend on the patch, so it runs while the patch is downloaded and explained
+        # Each task runs in a copy of the caller's context so its timings are recorded under the caller's event
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            event_future = executor.submit(contextvars.copy_context().run, summarize_event)
+            commit_future = executor.submit(contextvars.copy_context().run, summarize_commit)
+            event_response = event_future.result()
+            commit_response = commit_future.result()
         print(f"Natural language response: {event_response}\n")
         print(f"Natural language response: {commit_response}\n")
-        ai_response = event_response + 'n' +  commit_response
+        ai_response = event_response + '\n' +  commit_response
         return ai_response
 
 def send_to_google_chat(webhook_url, ai_message):
@@ -88,7 +132,7 @@ def send_to_google_chat(webhook_url, ai_message):
     }
     data = {'text': ai_message}
     try:
-        response = requests.post(webhook_url, data=json.dumps(data), headers=headers)
+        response = get_session().post(webhook_url, data=json.dumps(data), headers=headers, timeout=HTTP_TIMEOUT)
         if response.status_code != 200:
             print(f"Error sending message to Google Chat (Status code: {response.status_code})")
     except Exception as e:
@@ -102,7 +146,7 @@ def format_pull_request_event(event):
     event (dict): The event data from GitHub.
 
     Returns:
-    str: Formatted message string.
+    tuple: Formatted message string and the patch URL of the pull request.
     """
     action = event['payload']['action']
     pr = event['payload']['pull_request']
@@ -142,19 +186,8 @@ def format_pull_request_event(event):
         f"Mergeable State: {mergeable_state}\n"
         f"Additions: {additions}, Deletions: {deletions}, Changed Files: {changed_files}"
     )
-    try:
-        response = requests.get(patch_url, allow_redirects=True)
-        if response.status_code != 200:
-            commit = "No commit found"
-            print(f"Error getting patch commit from merge request: {response.status_code})")
-        elif response.status_code == 200:
-            commit = response.content
-            print(f"Successfully retrieved patch commit from merge request: {response.status_code})")
-    except Exception as e:
-        commit = "No commit found"
-        print(f"An error occurred while getting the Commit: {e}")
     print(f"Formatted PullRequestEvent Message Type: {formatted_message}")
-    return formatted_message, commit
+    return formatted_message, patch_url
 
 def format_push_event(event):
     """
@@ -222,18 +255,14 @@ def get_github_events(event_type):
     list: List of filtered and formatted GitHub events.
     """
     github_repository = os.getenv('GITHUB_REPOSITORY')
-    github_token = os.getenv('GITHUB_TOKEN')
-    api_url = f"https://api.github.com/repos/{github_repository}/events"
-    headers = {
-        'Accept': 'application/vnd.github+json',
-        'Authorization': f'token {github_token}'
-    }
+    api_url = f"{GITHUB_API_URL}/repos/{github_repository}/events"
+    headers = github_headers()
     try:
-        response = requests.get(api_url, headers=headers)
+        response = get_session().get(api_url, headers=headers, timeout=HTTP_TIMEOUT)
         #print(f"GitHub API Response: {response.status_code}, {response.text}")  # Log the raw response
         if response.status_code == 200:
             events = response.json()
-            print(f"Successfully fetched {events[1]} events")
+            print(f"Successfully fetched {len(events)} events")
             if events and events[0]['type'] == event_type:
                 print(f"Successfully fetched {events[0]} event")
                 return events[0]
@@ -245,24 +274,183 @@ def get_github_events(event_type):
         print(f"An error occurred: {e}")
         return []
 
-if __name__ == "__main__":
-    google_chat_webhook_url = os.getenv('GOOGLE_CHAT_WEBHOOK')
-    event_type = os.getenv('GITHUB_EVENT_TYPE')  # Event type from environment variable
+def github_headers():
+    return {
+        'Accept': 'application/vnd.github+json',
+        'Authorization': f"token {os.getenv('GITHUB_TOKEN')}"
+    }
 
-    
+def load_events_state(path):
+    """
+    Load the ETag and last processed event ID saved by the previous batch run.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable events state {path}: {e}")
+        return {}
+
+def save_events_state(path, state):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+def fetch_new_events(state):
+    """
+    Page through the repository events newer than the last processed one.
+
+    Parameters:
+    state (dict): The ETag and last event ID saved by the previous run.
+
+    Returns:
+    tuple: New events oldest first, and the ETag of the first page. The events are None if a page could not be fetched.
+    """
+    github_repository = os.getenv('GITHUB_REPOSITORY')
+    last_seen = int(state.get("last_event_id") or 0)
+    etag = state.get("etag")
+    headers = github_headers()
+    if etag:
+        # An unchanged first page answers 304 and does not count against the rate limit
+        headers['If-None-Match'] = etag
+    url = f"{GITHUB_API_URL}/repos/{github_repository}/events?per_page=100"
+    new_events = []
+    first_page = True
+    while url:
+        try:
+            response = get_session().get(url, headers=headers, timeout=HTTP_TIMEOUT)
+        except requests.RequestException as e:
+            # Same as a failed page, the next run starts again from the saved cursor
+            print(f"An error occurred while fetching events: {e}")
+            return None, None
+        if first_page and response.status_code == 304:
+            print("No new events since the last run")
+            return [], etag
+        if response.status_code != 200:
+            # Newer pages alone would move the cursor past the events on the missing ones, so nothing is returned
+            print(f"Error: Unable to fetch data (Status code: {response.status_code})")
+            return None, None
+        if first_page:
+            etag = response.headers.get('ETag')
+            headers.pop('If-None-Match', None)
+            first_page = False
+        try:
+            events = response.json()
+        except ValueError as e:
+            print(f"An error occurred while reading events: {e}")
+            return None, None
+        older = [event for event in events if int(event['id']) <= last_seen]
+        new_events.extend(event for event in events if int(event['id']) > last_seen)
+        if older or not last_seen:
+            # Reached events processed by the previous run, or this is the first run
+            break
+        url = response.links.get('next', {}).get('url')
+    new_events.sort(key=lambda event: int(event['id']))
+    if not last_seen:
+        # Without a previous run only the latest event is new, older ones were never meant to be posted
+        new_events = new_events[-1:]
+    print(f"Fetched {len(new_events)} new events")
+    return new_events, etag
+
+def summarize_event(event):
+    """
+    Format an event and generate its natural language summary.
+
+    Returns:
+    str: The summary, or None if the event type is not supported.
+    """
+    if event['type'] == 'PushEvent':
+        message = format_push_event(event)
+        return pushevent_ask(message, event['type'])
+    elif event['type'] == 'PullRequestEvent':
+        message, patch_url = format_pull_request_event(event)
+        return pullrequestevent_ask(message, patch_url, event['type'])
+    return None
+
+def process_events_batch(webhook_url, state_path):
+    """
+    Summarise every new Push and PullRequest event and post them to Google Chat in order.
+
+    Parameters:
+    webhook_url (str): The URL of the webhook for the Google Chat room.
+    state_path (str): File the ETag and last processed event ID are kept in between runs.
+    """
+    state = load_events_state(state_path)
+    with timed("fetch_events"):
+        events, etag = fetch_new_events(state)
+    if events is None:
+        # The cursor and ETag are left as they are, so the next run fetches the same events again
+        return
+    max_workers = int(os.getenv("EVENTS_MAX_WORKERS", "4"))
+
+    def summarize(event):
+        if event['type'] not in SUPPORTED_EVENTS:
+            return event, None, None
+        timing_scope.set(f"event {event['id']}")
+        try:
+            return event, summarize_event(event), None
+        except Exception as e:
+            print(f"An error occurred while summarising event {event['id']}: {e}")
+            return event, None, e
+
+    with timed("summaries"):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(summarize, events))
+    processed = 0
+    with timed("send_chat"):
+        for event, ai_message, error in results:
+            if error is not None:
+                # Later events are retried by the next run together with this one
+                break
+            if ai_message:
+                send_to_google_chat(webhook_url, ai_message)
+            state["last_event_id"] = event['id']
+            processed += 1
+    if processed == len(results):
+        state["etag"] = etag
+    else:
+        # A saved ETag would make the next run get a 304 and never retry the remaining events
+        state.pop("etag", None)
+    save_events_state(state_path, state)
+
+def process_latest_event(webhook_url, event_type):
+    """
+    Summarise the latest repository event if it is of the type that triggered the workflow.
+    """
     print(f"Event Type: {event_type}")
-    event = get_github_events(event_type)
+    with timed("fetch_events"):
+        event = get_github_events(event_type)
     if event and event['type'] == 'PushEvent':
         print("Processing PushEvent")
         message = format_push_event(event)
         #print(f"PushEvent Message: {message}")
-        ai_message = pushevent_ask(message, event_type)
+        with timed("event_summary"):
+            ai_message = pushevent_ask(message, event_type)
         #print(f"AI Message: {ai_message}")
-        send_to_google_chat(google_chat_webhook_url, ai_message)
+        with timed("send_chat"):
+            send_to_google_chat(webhook_url, ai_message)
     elif event and event['type'] == 'PullRequestEvent':
         print("Processing PullRequestEvent")
-        message, commit = format_pull_request_event(event)
-        ai_message = pullrequestevent_ask(message, commit, event_type)
-        send_to_google_chat(google_chat_webhook_url, ai_message)
+        message, patch_url = format_pull_request_event(event)
+        with timed("summaries"):
+            ai_message = pullrequestevent_ask(message, patch_url, event_type)
+        with timed("send_chat"):
+            send_to_google_chat(webhook_url, ai_message)
     else:
             print("Error: Non-string elements found in events_messages")
+
+if __name__ == "__main__":
+    google_chat_webhook_url = os.getenv('GOOGLE_CHAT_WEBHOOK')
+    event_type = os.getenv('GITHUB_EVENT_TYPE')  # Event type from environment variable
+
+    # "batch" posts every new event since the previous run, "latest" only the newest one
+    if os.getenv("EVENTS_MODE", "latest") == "batch":
+        process_events_batch(google_chat_webhook_url, os.getenv("GITHUB_EVENTS_STATE", ".cache/github-events.json"))
+    else:
+        process_latest_event(google_chat_webhook_url, event_type)
+    print_timings()
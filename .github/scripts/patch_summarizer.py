@@ -0,0 +1,275 @@
+import fnmatch
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+# Files that are generated, vendored or lock files say little about the change and cost the most tokens
+SKIPPED_PATTERNS = [
+    "*.lock", "*.lock.hcl", "*.lock.json", "package-lock.json", "yarn.lock", "pnpm-lock.yaml", "go.sum",
+    "*.min.js", "*.min.css", "*.map", "*.pb.go", "*_pb2.py", "*_pb2_grpc.py", "*.generated.*", "*.tfstate", "*.tfstate.backup",
+    "vendor/*", "*/vendor/*", "node_modules/*", "*/node_modules/*", "third_party/*", "dist/*", "build/*",
+]
+
+MAP_TEMPLATE = '''
+        You are a a helpful assistant that understands Infrastructure as Code, Python, JSON, JavaScript, and YAML. Your goal is to provide detailed descriptions over the follwing Merge Request Patch snippets of code.
+
+        Explain what changes were made in the following code snippet from {path}: {hunks}
+        '''
+
+REDUCE_TEMPLATE = '''
+        You are a a helpful assistant that understands Infrastructure as Code, Python, JSON, JavaScript, and YAML.
+        The following are explanations of the changes made to each file of a Merge Request. Combine them into one summary of what the Merge Request changes, grouped by file.
+
+        {summaries}
+        '''
+
+
+def estimate_tokens(text):
+    """
+    Estimate the number of tokens in a piece of text (about four characters per token).
+    """
+    return len(text) // 4 + 1
+
+def is_skipped(path):
+    """
+    Check whether a changed file is generated, vendored or a lock file.
+
+    Parameters:
+    path (str): Path of the file in the repository.
+
+    Returns:
+    bool: True if the file should be left out of the summary.
+    """
+    name = os.path.basename(path)
+    return any(fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in SKIPPED_PATTERNS)
+
+def parse_patch(lines, token_budget, stats):
+    """
+    Split a streamed patch into files and hunks.
+
+    Parameters:
+    lines (iterable): Lines of the patch, read as they arrive.
+    token_budget (int): Hunks past this many tokens are dropped.
+    stats (dict): Counters updated while parsing.
+
+    Returns:
+    generator: Dicts with the file path, its blob SHA and its hunks.
+    """
+    current = None
+    hunk = None
+    used = 0
+
+    def finish():
+        if current is not None and not current["skip"] and current["hunks"]:
+            return current
+        return None
+
+    for line in lines:
+        if line.startswith("diff --git "):
+            done = finish()
+            if done:
+                yield done
+            path = line.rsplit(" b/", 1)[-1]
+            current = {"path": path, "blob": "", "skip": is_skipped(path), "hunks": []}
+            hunk = None
+            stats["files"] += 1
+            if current["skip"]:
+                stats["skipped_files"].append(path)
+            continue
+        if current is None:
+            # Commit headers and messages of a format-patch, nothing to summarise
+            continue
+        if line == "-- ":
+            # End of one commit in a format-patch
+            done = finish()
+            if done:
+                yield done
+            current, hunk = None, None
+            continue
+        if hunk is None and line.startswith("index "):
+            # index 1a2b3c..4d5e6f 100644, the post-image blob identifies the file content
+            current["blob"] = line.split()[1].split("..")[-1]
+            continue
+        if line.startswith("Binary files"):
+            if not current["skip"]:
+                current["skip"] = True
+                stats["skipped_files"].append(current["path"])
+            continue
+        if line.startswith("@@"):
+            hunk = [line]
+            if current["skip"]:
+                continue
+            if used >= token_budget:
+                stats["over_budget_hunks"] += 1
+                continue
+            current["hunks"].append(hunk)
+            stats["hunks"] += 1
+            used += estimate_tokens(line)
+            continue
+        if hunk is not None and (line == "" or line[0] in " +-\\"):
+            if not current["skip"] and current["hunks"] and current["hunks"][-1] is hunk:
+                hunk.append(line)
+                used += estimate_tokens(line)
+    done = finish()
+    if done:
+        yield done
+
+def build_units(patch_file, unit_tokens):
+    """
+    Pack the hunks of one file into units that fit a single LLM call.
+
+    Parameters:
+    patch_file (dict): A file produced by parse_patch.
+    unit_tokens (int): Token limit of one unit.
+
+    Returns:
+    list: Units with the file path, the hunk text and a cache key.
+    """
+    units = []
+    texts, keys, size = [], [], 0
+    for hunk in patch_file["hunks"]:
+        text = "\n".join(hunk)
+        if estimate_tokens(text) > unit_tokens:
+            text = text[:unit_tokens * 4] + "\n... (hunk truncated)"
+        # Keyed by the blob SHA and the hunk content, a re-run on the same PR finds it again
+        key = hashlib.sha256(f"{patch_file['blob']}\0{text}".encode("utf-8")).hexdigest()
+        if texts and size + estimate_tokens(text) > unit_tokens:
+            units.append(make_unit(patch_file["path"], texts, keys))
+            texts, keys, size = [], [], 0
+        texts.append(text)
+        keys.append(key)
+        size += estimate_tokens(text)
+    if texts:
+        units.append(make_unit(patch_file["path"], texts, keys))
+    return units
+
+def make_unit(path, texts, keys):
+    return {
+        "path": path,
+        "hunks": "\n".join(texts),
+        "key": hashlib.sha256("\0".join(keys).encode("utf-8")).hexdigest(),
+    }
+
+def load_cache(path):
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable patch summary cache {path}: {e}")
+        return {}
+
+# Batch mode summarises several pull requests at once, each saving the same cache file
+_cache_lock = threading.Lock()
+
+def save_cache(path, cache, max_entries):
+    if not path:
+        return
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with _cache_lock:
+        # Keep what other summaries saved since this one loaded the cache
+        merged = {key: summary for key, summary in load_cache(path).items() if key not in cache}
+        merged.update(cache)
+        # Dicts keep insertion order, entries used by this run were written last
+        entries = list(merged.items())[-max_entries:]
+        with tempfile.NamedTemporaryFile("w", dir=directory or ".", suffix=".tmp", delete=False) as f:
+            json.dump(dict(entries), f)
+        os.replace(f.name, path)
+
+def summarize_patch(llm, session, patch_url, timeout):
+    """
+    Summarise a Pull Request patch with map-reduce.
+
+    Each file is summarised in units of hunks in parallel, and the summaries are combined into one.
+
+    Parameters:
+    llm: The LLM used for the map and reduce prompts.
+    session (requests.Session): Session used to stream the patch.
+    patch_url (str): The patch URL of the pull request.
+    timeout (float): HTTP timeout in seconds.
+
+    Returns:
+    str: Summary of the changes made by the patch.
+    """
+    token_budget = int(os.getenv("PATCH_TOKEN_BUDGET", "60000"))
+    unit_tokens = int(os.getenv("PATCH_UNIT_TOKENS", "6000"))
+    max_workers = int(os.getenv("PATCH_MAX_WORKERS", "4"))
+    cache_path = os.getenv("PATCH_SUMMARY_CACHE", ".cache/patch-summaries.json")
+    stats = {"files": 0, "skipped_files": [], "hunks": 0, "over_budget_hunks": 0, "units": 0, "cache_hits": 0}
+
+    try:
+        response = session.get(patch_url, allow_redirects=True, stream=True, timeout=timeout)
+        if response.status_code != 200:
+            print(f"Error getting patch commit from merge request: {response.status_code})")
+            return "No commit found"
+        # iter_lines only decodes when the response declares an encoding
+        response.encoding = response.encoding or "utf-8"
+        with response:
+            units = []
+            for patch_file in parse_patch(response.iter_lines(decode_unicode=True), token_budget, stats):
+                units.extend(build_units(patch_file, unit_tokens))
+    except Exception as e:
+        print(f"An error occurred while getting the Commit: {e}")
+        return "No commit found"
+    stats["units"] = len(units)
+    if not units:
+        return "No reviewable changes found, only generated, vendored, lock or binary files were changed."
+
+    cache = load_cache(cache_path)
+
+    def summarize_unit(unit):
+        # Cached entries are re-inserted so the ones still in use survive the size bound
+        summary = cache.pop(unit["key"], None)
+        if summary is not None:
+            stats["cache_hits"] += 1
+        else:
+            summary = llm.predict(MAP_TEMPLATE.format(path=unit["path"], hunks=unit["hunks"])).strip()
+        cache[unit["key"]] = summary
+        return f"{unit['path']}:\n{summary}"
+
+    def reduce_group(group):
+        if len(group) == 1:
+            # A summary left over at the end of a round goes on to the next one as it is
+            return group[0]
+        text = "\n\n".join(group)
+        key = "reduce-" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+        summary = cache.pop(key, None)
+        if summary is None:
+            summary = llm.predict(REDUCE_TEMPLATE.format(summaries=text)).strip()
+        cache[key] = summary
+        return summary
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        summaries = list(executor.map(summarize_unit, units))
+        # Reduce in groups that fit one prompt until a single summary is left
+        # A group takes at least two summaries even if they do not fit, otherwise large summaries would never shrink in number
+        while len(summaries) > 1:
+            groups, group, size = [], [], 0
+            for summary in summaries:
+                if len(group) >= 2 and size + estimate_tokens(summary) > unit_tokens:
+                    groups.append(group)
+                    group, size = [], 0
+                group.append(summary)
+                size += estimate_tokens(summary)
+            groups.append(group)
+            summaries = list(executor.map(reduce_group, groups))
+    save_cache(cache_path, cache, int(os.getenv("PATCH_SUMMARY_CACHE_MAX_ENTRIES", "5000")))
+
+    print(
+        f"Patch: {stats['files']} files, {len(stats['skipped_files'])} skipped, {stats['hunks']} hunks in {stats['units']} units, "
+        f"{stats['cache_hits']} cached, {stats['over_budget_hunks']} hunks over the token budget"
+    )
+    summary = summaries[0]
+    if stats["skipped_files"]:
+        summary += "\nNot summarised (generated, vendored, lock or binary): " + ", ".join(stats["skipped_files"])
+    if stats["over_budget_hunks"]:
+        summary += f"\n{stats['over_budget_hunks']} hunks were left out to stay within the token budget."
+    return summary
@@ -0,0 +1,104 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import numpy as np
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.embedding_providers import get_embedding_provider
+from modules.tfstate_resources import resource_address
+from modules.tfstate_splitter import TerraformStateSplitter
+
+
+
+# Compares embedding providers on local tfstate files:
+#   python benchmarks/embedding_benchmark.py state1.tfstate state2.tfstate --providers cohere local
+# Each resource becomes a query ("google compute instance web") whose answer is any chunk of that resource.
+
+def load_chunks(paths, chunk_size):
+    splitter = TerraformStateSplitter(chunk_size=chunk_size)
+    docs = []
+    for path in paths:
+        with open(path) as f:
+            state = json.load(f)
+        for resource in state.get("resources", []):
+            docs.extend(splitter.split_resource(resource, {"source": path, "address": resource_address(resource)}))
+    return docs
+
+def build_queries(docs, count, seed):
+    addresses = {}
+    for doc in docs:
+        metadata = doc.metadata
+        addresses[metadata["address"]] = f"{metadata['resource_type'].replace('_', ' ')} {metadata['resource_name']}"
+    items = sorted(addresses.items())
+    random.Random(seed).shuffle(items)
+    return items[:count]
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype="float32")
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+def benchmark(name, docs, queries, k):
+    provider = get_embedding_provider(name)
+    texts = [doc.page_content for doc in docs]
+    addresses = np.array([doc.metadata["address"] for doc in docs])
+
+    start = time.perf_counter()
+    vectors = []
+    for i in range(0, len(texts), provider.batch_size):
+        vectors.extend(provider.embeddings.embed_documents(texts[i:i + provider.batch_size]))
+    embed_seconds = time.perf_counter() - start
+    matrix = normalize(vectors)
+
+    latencies = []
+    hits = 0
+    reciprocal_ranks = 0.0
+    for address, query in queries:
+        start = time.perf_counter()
+        query_vector = normalize(provider.embeddings.embed_query(query))
+        latencies.append(time.perf_counter() - start)
+        ranked = addresses[np.argsort(-(matrix @ query_vector))]
+        # Several chunks can belong to one resource, rank resources by their best chunk
+        seen = list(dict.fromkeys(ranked[:k * 10]))
+        if address in seen[:k]:
+            hits += 1
+        if address in seen:
+            reciprocal_ranks += 1.0 / (seen.index(address) + 1)
+
+    return {
+        "provider": provider.model_id,
+        "chunks": len(texts),
+        "dimension": matrix.shape[1],
+        "chunks_per_second": len(texts) / embed_seconds if embed_seconds > 0 else float("inf"),
+        "query_p50_ms": float(np.percentile(latencies, 50)) * 1000 if latencies else 0.0,
+        "query_p95_ms": float(np.percentile(latencies, 95)) * 1000 if latencies else 0.0,
+        f"recall@{k}": hits / len(queries) if queries else 0.0,
+        "mrr": reciprocal_ranks / len(queries) if queries else 0.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare embedding providers on tfstate files")
+    parser.add_argument("states", nargs="+", help="Local Terraform state files")
+    parser.add_argument("--providers", nargs="+", default=["cohere", "local"])
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--chunk-size", type=int, default=1500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    load_dotenv()
+    docs = load_chunks(args.states, args.chunk_size)
+    queries = build_queries(docs, args.queries, args.seed)
+    print(f"{len(docs)} chunks, {len(queries)} queries")
+    for name in args.providers:
+        result = benchmark(name, docs, queries, args.k)
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
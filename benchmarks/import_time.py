@@ -0,0 +1,77 @@
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+
+
+# Measures cold import time with `python -X importtime` so startup regressions show up in review:
+#   python benchmarks/import_time.py
+#   python benchmarks/import_time.py --max-ms modules.llm_library=3000 --json > import_time.json
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MODULES = [
+    "modules.llm_library",
+    "modules.tf_reader_utility",
+    "modules.ingest_jobs",
+    ".github/scripts/github_details.py",
+]
+IMPORT_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+def measure(target, python):
+    if target.endswith(".py"):
+        # Scripts are imported by path without running their __main__ block
+        directory, name = os.path.split(os.path.join(REPO_ROOT, target))
+        code = f"import sys; sys.path.insert(0, {directory!r}); import {name[:-3]}"
+    else:
+        code = f"import {target}"
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", code],
+        cwd=REPO_ROOT, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {target} failed:\n{result.stderr[-2000:]}")
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            imports.append({"module": module, "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000, "depth": len(indent) // 2})
+    # Top level imports are the ones the interpreter started itself, their cumulative times add up to the total
+    total_ms = sum(item["cumulative_ms"] for item in imports if item["depth"] == 0)
+    return total_ms, imports
+
+def main():
+    parser = argparse.ArgumentParser(description="Report cold import time of the app and CI modules")
+    parser.add_argument("targets", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--top", type=int, default=10, help="Slowest packages to list per target")
+    parser.add_argument("--max-ms", action="append", default=[], metavar="TARGET=MS", help="Fail if TARGET takes longer than MS")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--python", default=sys.executable)
+    args = parser.parse_args()
+
+    limits = dict(item.split("=", 1) for item in args.max_ms)
+    report = {}
+    failed = False
+    for target in args.targets:
+        total_ms, imports = measure(target, args.python)
+        slowest = sorted(imports, key=lambda item: item["self_ms"], reverse=True)[:args.top]
+        report[target] = {"total_ms": total_ms, "slowest": slowest}
+        if target in limits and total_ms > float(limits[target]):
+            failed = True
+            print(f"{target} took {total_ms:.0f} ms, over the {limits[target]} ms limit", file=sys.stderr)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for target, result in report.items():
+            print(f"{target}: {result['total_ms']:.0f} ms")
+            for item in result["slowest"]:
+                print(f"    {item['self_ms']:8.1f} ms  {item['module']}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import zlib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_state import resource_address, resource_identity, write_state
+
+
+
+# Offline ingest and retrieval benchmark on synthetic states, no Cohere, LLM or GCS access needed:
+#   python benchmarks/ingest_benchmark.py --resources 100 1000 10000 --stores faiss memory --splitters resource recursive
+# Every combination runs in its own process so peak RSS is measured per configuration. Results are JSON lines.
+
+BENCHMARK_PROJECT = "benchmark"
+BENCHMARK_BUCKET = "benchmark-states"
+TOKEN = re.compile(r"[a-z0-9]+")
+
+
+class HashEmbeddings():
+    # Deterministic bag-of-words vectors, texts sharing words end up close so recall is still meaningful
+    def __init__(self, dimension=384, latency_ms=0.0):
+        self.dimension = dimension
+        self.latency_ms = latency_ms
+
+    def embed(self, text):
+        vector = np.zeros(self.dimension, dtype="float32")
+        for word in TOKEN.findall(text.lower()):
+            vector[zlib.crc32(word.encode("utf-8")) % self.dimension] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        if self.latency_ms:
+            # Stands in for the provider round trip of one batch
+            time.sleep(self.latency_ms / 1000)
+        return [self.embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed(text)
+
+
+class LocalBlob():
+    def __init__(self, name, path, generation):
+        self.name = name
+        self.path = path
+        self.generation = generation
+        self.size = os.path.getsize(path)
+
+    def open(self, mode="rb", **kwargs):
+        return open(self.path, mode)
+
+
+class LocalBucket():
+    def __init__(self, name):
+        self.name = name
+        self.blobs = {}
+
+    def get_blob(self, name):
+        return self.blobs.get(name)
+
+
+class LocalStorageClient():
+    # Serves state files from local disk through the subset of google.cloud.storage the reader uses
+    def __init__(self):
+        self.buckets = {BENCHMARK_BUCKET: LocalBucket(BENCHMARK_BUCKET)}
+
+    def get_bucket(self, name):
+        return self.buckets[name]
+
+
+def percentile_ms(latencies, q):
+    return float(np.percentile(latencies, q)) * 1000 if latencies else 0.0
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def build_queries(resources, count, seed):
+    # "compute instance web 42" should find module.apps["web"].google_compute_instance.web_42
+    queries = []
+    for index in random.Random(seed).sample(range(resources), min(count, resources)):
+        _, identity = resource_identity(index, seed)
+        words = identity["type"].replace("google_", "").replace("_", " ")
+        queries.append((resource_address(identity), f"{words} {identity['name'].replace('_', ' ')}"))
+    return queries
+
+def configure(config, workdir):
+    os.environ.update({
+        "VECTOR_STORE": config["store"],
+        "VECTOR_STORE_PATH": os.path.join(workdir, "indexes"),
+        "TFSTATE_SPLITTER": config["splitter"],
+        "TFSTATE_CHUNK_SIZE": str(config["chunk_size"]),
+        "INGEST_BATCH_SIZE": str(config["batch_size"]),
+        "RETRIEVER": config["retriever"],
+        "RETRIEVER_K": str(config["k"]),
+        "EMBEDDING_PROVIDER": "benchmark",
+        "EMBEDDING_CACHE_BACKEND": "memory",
+        "ANSWER_CACHE_MAX_ENTRIES": "0",
+        "MEMORY_MODE": "buffer",
+        "CONDENSE_LLM": "",
+        "TELEMETRY_PROMETHEUS_PORT": "0",
+    })
+    # LLMLibrary copies these into os.environ and fails if they are unset
+    for name in ("OPENAI_API_TYPE", "OPENAI_API_VERSION", "OPENAI_API_BASE", "OPENAI_API_KEY"):
+        os.environ.setdefault(name, "benchmark")
+
+    from langchain.chat_models.fake import FakeListChatModel
+    from modules.client_pool import get_client_pool
+    from modules.embedding_providers import EMBEDDING_PROVIDERS, EmbeddingProvider
+
+    embeddings = HashEmbeddings(config["dimension"], config["embed_latency_ms"])
+    EMBEDDING_PROVIDERS["benchmark"] = lambda: EmbeddingProvider(
+        f"benchmark/hash-{config['dimension']}", embeddings, batch_size=96, max_workers=config["embed_workers"],
+    )
+    # Pre-seeding the pool under the keys the app looks up swaps in the stand-ins without touching app code
+    pool = get_client_pool()
+    pool.get("google-auth", "default", lambda: (None, BENCHMARK_PROJECT))
+    storage_client = pool.get("gcs", BENCHMARK_PROJECT, LocalStorageClient)
+    llm = FakeListChatModel(responses=["Hello! Here is the Terraform you asked for."])
+    pool.get("azure-openai", "gpt-4", lambda: llm, temperature=0.0, streaming=True)
+    return storage_client
+
+def run(config):
+    workdir = tempfile.mkdtemp(prefix="tfassist-benchmark-")
+    try:
+        return measure(config, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def measure(config, workdir):
+    storage_client = configure(config, workdir)
+    from modules import llm_library
+    from modules.tf_reader_utility import TerraformReader
+    from modules.telemetry import get_telemetry
+    from modules.token_counter import count_tokens
+    from modules.vector_registry import get_registry
+    from modules.vector_store import estimate_store_bytes, index_dir
+
+    state_path = os.path.join(workdir, "state.tfstate")
+    state_bytes = write_state(state_path, config["resources"], config["seed"])
+    bucket = storage_client.buckets[BENCHMARK_BUCKET]
+    bucket.blobs["state.tfstate"] = LocalBlob("state.tfstate", state_path, 1)
+    source = f"gs://{BENCHMARK_BUCKET}/state.tfstate"
+    reader = TerraformReader()
+
+    start = time.perf_counter()
+    index_key = reader.get_tf_state(source, "benchmark")
+    ingest_seconds = time.perf_counter() - start
+    chunks = reader.split_stats["chunks"]
+    tokens = reader.split_stats["tokens"]
+    entry = get_registry().get(index_key)
+    result = {
+        "resources": config["resources"],
+        "store": config["store"],
+        "splitter": config["splitter"],
+        "chunk_size": config["chunk_size"],
+        "retriever": config["retriever"],
+        "state_mb": state_bytes / 1e6,
+        "chunks": chunks,
+        "chunk_tokens": tokens,
+        "ingest_seconds": ingest_seconds,
+        "resources_per_second": config["resources"] / ingest_seconds,
+        "chunks_per_second": chunks / ingest_seconds,
+        "mb_per_second": state_bytes / 1e6 / ingest_seconds,
+        "index_mb": estimate_store_bytes(entry.store) / 1e6,
+        "index_disk_mb": directory_bytes(index_dir(source)) / 1e6 if os.path.exists(index_dir(source)) else 0.0,
+    }
+
+    if config["changed_fraction"] > 0:
+        # Next serial with a fraction of the resources changed, only those are re-embedded
+        write_state(state_path, config["resources"], config["seed"], revision=1, changed_fraction=config["changed_fraction"])
+        bucket.blobs["state.tfstate"] = LocalBlob("state.tfstate", state_path, 2)
+        start = time.perf_counter()
+        index_key = reader.get_tf_state(source, "benchmark")
+        result["reingest_seconds"] = time.perf_counter() - start
+        result["reingest_chunks"] = reader.split_stats["chunks"]
+
+    # LLMLibrary.ask() reads the session from Streamlit, outside `streamlit run` a namespace stands in for it
+    llm_library.st = types.SimpleNamespace(session_state=types.SimpleNamespace(
+        llm="openai", index_key=index_key, session_id="benchmark",
+    ))
+    chain = reader.llmlibrary.ask()
+    queries = build_queries(config["resources"], config["queries"], config["seed"])
+    latencies = []
+    hits = 0
+    hits_retrieved = 0
+    documents = 0
+    context_tokens = 0
+    for address, query in queries:
+        start = time.perf_counter()
+        docs = chain.retriever.get_relevant_documents(query)
+        latencies.append(time.perf_counter() - start)
+        # The adaptive retriever can return more than k chunks, recall@k only counts the first k
+        hits += any(doc.metadata.get("address") == address for doc in docs[:config["k"]])
+        hits_retrieved += any(doc.metadata.get("address") == address for doc in docs)
+        documents += len(docs)
+        context_tokens += sum(count_tokens(doc.page_content) for doc in docs)
+    result.update({
+        "queries": len(queries),
+        "documents_per_query": documents / len(queries) if queries else 0.0,
+        "context_tokens_per_query": context_tokens / len(queries) if queries else 0.0,
+        "retrieval_p50_ms": percentile_ms(latencies, 50),
+        "retrieval_p95_ms": percentile_ms(latencies, 95),
+        f"recall@{config['k']}": hits / len(queries) if queries else 0.0,
+        # Over every chunk returned, read it together with documents_per_query
+        "recall_retrieved": hits_retrieved / len(queries) if queries else 0.0,
+    })
+
+    latencies = []
+    for _, query in queries[:config["chat_queries"]]:
+        chain.memory.clear()
+        start = time.perf_counter()
+        chain({"question": query})
+        latencies.append(time.perf_counter() - start)
+    result.update({
+        "chat_p50_ms": percentile_ms(latencies, 50),
+        "chat_p95_ms": percentile_ms(latencies, 95),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages_ms": {item["stage"]: item["mean_ms"] for item in get_telemetry().stage_summary() if item["status"] == "ok"},
+    })
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest and retrieval on synthetic Terraform states")
+    parser.add_argument("--resources", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--stores", nargs="+", default=["faiss", "memory"])
+    parser.add_argument("--splitters", nargs="+", default=["resource"])
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[1500])
+    parser.add_argument("--retrievers", nargs="+", default=["hybrid"])
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0, help="Simulated provider latency per embedding request")
+    parser.add_argument("--embed-workers", type=int, default=4)
+    parser.add_argument("--changed-fraction", type=float, default=0.01, help="Fraction of resources changed for the re-ingest, 0 skips it")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--chat-queries", type=int, default=20)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--config", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.config:
+        # Worker process: run one configuration and print its result last
+        result = run(json.loads(args.config))
+        print(json.dumps(result))
+        return
+
+    failed = False
+    combinations = itertools.product(args.resources, args.stores, args.splitters, args.chunk_sizes, args.retrievers)
+    for resources, store, splitter, chunk_size, retriever in combinations:
+        config = {
+            "resources": resources, "store": store, "splitter": splitter, "chunk_size": chunk_size, "retriever": retriever,
+            "batch_size": args.batch_size, "dimension": args.dimension, "embed_latency_ms": args.embed_latency_ms,
+            "embed_workers": args.embed_workers, "changed_fraction": args.changed_fraction, "queries": args.queries,
+            "chat_queries": args.chat_queries, "k": args.k, "seed": args.seed,
+        }
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), "--config", json.dumps(config)], capture_output=True, text=True)
+        if process.returncode != 0:
+            failed = True
+            print(f"{config} failed:\n{process.stderr[-2000:]}", file=sys.stderr)
+            continue
+        print(process.stdout.strip().splitlines()[-1], flush=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import argparse
+import json
+import random
+import uuid
+
+
+
+# Writes a synthetic Terraform state of any size, the same seed always gives the same file:
+#   python benchmarks/synthetic_state.py 10000 -o /tmp/state-10k.tfstate
+# Resource i only depends on (seed, i), so queries can be built for any resource without reading the state back.
+
+PROVIDER = 'provider["registry.terraform.io/hashicorp/google"]'
+REGIONS = ["us-central1", "us-east1", "us-west1", "europe-west1", "europe-west4", "asia-east1", "asia-southeast1"]
+MODULES = ["", "module.network", "module.gke", "module.data", "module.iam", "module.edge", "module.apps[\"billing\"]", "module.apps[\"search\"]"]
+ROLES = ["web", "api", "worker", "batch", "cache", "search", "billing", "auth", "ingest", "reports", "ml", "ops"]
+
+
+def instance_attributes(resource_type, name, region, rng, revision):
+    zone = f"{region}-{rng.choice('abc')}"
+    labels = {"env": rng.choice(["prod", "staging", "dev"]), "team": rng.choice(ROLES), "revision": str(revision)}
+    if resource_type == "google_compute_instance":
+        return {
+            "name": name, "zone": zone, "machine_type": rng.choice(["e2-medium", "n2-standard-4", "c2-standard-8"]),
+            "labels": labels, "tags": [rng.choice(ROLES), "ssh"],
+            "boot_disk": [{"initialize_params": [{"image": "debian-cloud/debian-12", "size": rng.choice([10, 50, 100])}]}],
+            "network_interface": [{"network": "vpc-main", "subnetwork": f"subnet-{region}", "network_ip": f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}"}],
+            "service_account": [{"email": f"{name}@example-project.iam.gserviceaccount.com", "scopes": ["cloud-platform"]}],
+        }
+    if resource_type == "google_storage_bucket":
+        return {
+            "name": f"example-{name}", "location": region.upper(), "storage_class": rng.choice(["STANDARD", "NEARLINE", "COLDLINE"]),
+            "uniform_bucket_level_access": rng.random() < 0.8, "labels": labels,
+            "versioning": [{"enabled": rng.random() < 0.5}],
+            "lifecycle_rule": [{"action": [{"type": "Delete"}], "condition": [{"age": rng.choice([30, 90, 365])}]}],
+        }
+    if resource_type == "google_sql_database_instance":
+        return {
+            "name": name, "region": region, "database_version": rng.choice(["POSTGRES_15", "MYSQL_8_0"]),
+            "settings": [{"tier": rng.choice(["db-f1-micro", "db-custom-2-7680"]), "availability_type": rng.choice(["ZONAL", "REGIONAL"]), "user_labels": labels}],
+            "deletion_protection": True,
+        }
+    if resource_type == "google_container_cluster":
+        return {
+            "name": name, "location": region, "initial_node_count": rng.choice([1, 3]), "resource_labels": labels,
+            "release_channel": [{"channel": rng.choice(["REGULAR", "STABLE"])}], "networking_mode": "VPC_NATIVE",
+            "master_auth": [{"cluster_ca_certificate": uuid.UUID(int=rng.getrandbits(128)).hex * 8}],
+        }
+    if resource_type == "google_compute_firewall":
+        return {
+            "name": name, "network": "vpc-main", "direction": "INGRESS", "priority": rng.choice([900, 1000]),
+            "allow": [{"protocol": "tcp", "ports": [str(rng.choice([22, 80, 443, 5432, 8080]))]}],
+            "source_ranges": [f"10.{rng.randrange(256)}.0.0/16"], "target_tags": [rng.choice(ROLES)],
+        }
+    if resource_type == "google_pubsub_topic":
+        return {"name": name, "labels": labels, "message_retention_duration": rng.choice(["86400s", "604800s"])}
+    if resource_type == "google_service_account":
+        return {"account_id": name, "display_name": f"{name} service account", "email": f"{name}@example-project.iam.gserviceaccount.com"}
+    if resource_type == "google_project_iam_member":
+        return {"project": "example-project", "role": rng.choice(["roles/viewer", "roles/storage.objectAdmin", "roles/pubsub.publisher"]), "member": f"serviceAccount:{name}@example-project.iam.gserviceaccount.com"}
+    if resource_type == "google_dns_record_set":
+        return {"name": f"{name}.example.com.", "type": "A", "ttl": 300, "rrdatas": [f"34.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}"]}
+    return {"name": name, "region": region, "ip_cidr_range": f"10.{rng.randrange(256)}.0.0/20", "network": "vpc-main"}
+
+# Weighted towards the types that dominate real states
+RESOURCE_TYPES = [
+    ("google_compute_instance", 20), ("google_storage_bucket", 15), ("google_project_iam_member", 15),
+    ("google_service_account", 10), ("google_compute_firewall", 10), ("google_pubsub_topic", 8),
+    ("google_dns_record_set", 8), ("google_compute_subnetwork", 6), ("google_sql_database_instance", 4),
+    ("google_container_cluster", 4),
+]
+
+def resource_identity(index, seed):
+    # The random draws that place a resource come first, so dependencies can be addressed without building them
+    rng = random.Random(seed * 1_000_003 + index)
+    resource_type = rng.choices([item[0] for item in RESOURCE_TYPES], [item[1] for item in RESOURCE_TYPES])[0]
+    name = f"{rng.choice(ROLES)}_{index}"
+    region = rng.choice(REGIONS)
+    module = rng.choice(MODULES)
+    mode = "data" if rng.random() < 0.03 else "managed"
+    return rng, {"mode": mode, "type": resource_type, "name": name, "module": module, "region": region}
+
+def resource_address(identity):
+    address = f"{identity['type']}.{identity['name']}"
+    if identity["mode"] == "data":
+        address = f"data.{address}"
+    if identity["module"]:
+        address = f"{identity['module']}.{address}"
+    return address
+
+def make_resource(index, seed=0, revision=0, changed_fraction=0.0):
+    """
+    Build resource number `index` of a synthetic state.
+
+    Parameters:
+    index (int): Position of the resource in the state.
+    seed (int): Seed of the state, the same seed and index give the same resource.
+    revision (int): Revision of the state, later revisions change a fraction of the resources.
+    changed_fraction (float): Fraction of the resources whose attributes change in each revision.
+
+    Returns:
+    dict: The resource as Terraform writes it to .resources[].
+    """
+    rng, identity = resource_identity(index, seed)
+    name = identity["name"]
+    # A resource only picks up the latest revision if it is in the changed fraction of that revision
+    resource_revision = max((r for r in range(1, revision + 1) if random.Random(f"{seed}:{r}:{index}").random() < changed_fraction), default=0)
+    resource = {
+        "mode": identity["mode"],
+        "type": identity["type"],
+        "name": name,
+        "provider": PROVIDER,
+    }
+    if identity["module"]:
+        resource["module"] = identity["module"]
+    instances = []
+    count = rng.choice([1] * 8 + [2, 3])
+    for instance in range(count):
+        instance_name = name.replace("_", "-") if count == 1 else f"{name.replace('_', '-')}-{instance}"
+        item = {
+            "schema_version": 0,
+            "attributes": instance_attributes(identity["type"], instance_name, identity["region"], rng, resource_revision),
+            "sensitive_attributes": [],
+            "private": uuid.UUID(int=rng.getrandbits(128)).hex,
+        }
+        if count > 1:
+            item["index_key"] = instance
+        if index > 0 and rng.random() < 0.5:
+            _, dependency = resource_identity(rng.randrange(index), seed)
+            item["dependencies"] = [resource_address(dependency)]
+        instances.append(item)
+    resource["instances"] = instances
+    return resource
+
+def write_state(path, resources, seed=0, revision=0, changed_fraction=0.0):
+    """
+    Write a synthetic state file one resource at a time, so even 100k resources use little memory.
+
+    Parameters:
+    path (str): File to write.
+    resources (int): Number of resources.
+    seed (int): Seed of the state.
+    revision (int): Revision of the state, written as its serial.
+    changed_fraction (float): Fraction of the resources changed in each revision.
+
+    Returns:
+    int: Size of the file in bytes.
+    """
+    lineage = str(uuid.UUID(int=random.Random(seed).getrandbits(128)))
+    with open(path, "w") as f:
+        f.write(json.dumps({"version": 4, "terraform_version": "1.6.6", "serial": revision + 1, "lineage": lineage, "outputs": {}})[:-1])
+        f.write(', "resources": [')
+        for index in range(resources):
+            if index:
+                f.write(",\n")
+            f.write(json.dumps(make_resource(index, seed, revision, changed_fraction), indent=2))
+        f.write("],\n\"check_results\": null}\n")
+        return f.tell()
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic Terraform state file")
+    parser.add_argument("resources", type=int)
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--revision", type=int, default=0)
+    parser.add_argument("--changed-fraction", type=float, default=0.01)
+    args = parser.parse_args()
+    size = write_state(args.output, args.resources, args.seed, args.revision, args.changed_fraction)
+    print(f"Wrote {args.resources} resources ({size / 1e6:.1f} MB) to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,19 @@
+import json
 import os
 import re
+import time
+import uuid
 from html import escape
-import google.auth
 import streamlit as st
-from google.cloud import storage, aiplatform
+from langchain.schema import HumanMessage, AIMessage
 from modules.tf_reader_utility import TerraformReader
 from modules.llm_library import LLMLibrary
+from modules.ingest_jobs import get_ingest_queue, READY, FAILED
+from modules.streaming_handler import StreamlitTokenHandler
+from modules.chat_renderer import ChatRenderer
+from modules.answer_cache import get_answer_cache
+from modules.telemetry import get_telemetry
+from modules.vector_registry import get_registry
 from dotenv import load_dotenv
 from htmlTemplates import css, bot_template, user_template
 
@@ -13,21 +21,25 @@ class TF_ASSISTANT():
     
     def initiate(self):
         if not hasattr(st.session_state, 'init') or st.session_state.init is None:
-            # Google Auth and Vertex AI Init
+            # Google credentials and Vertex AI are initialised once per process on first use, see modules/client_pool.py
             load_dotenv()
-            print(f"Initializing Google Auth and Vertex AI")
-            st.session_state.terraformreader = TerraformReader()
             st.session_state.llmlibrary = LLMLibrary()
-            self.credentials = google.auth.default()
-            self.project = os.getenv("PROJECT_ID")
-            aiplatform.init(project=self.project, location="us-central1")
+            # Identifies this browser session to the shared vector store registry
+            st.session_state.session_id = uuid.uuid4().hex
             st.session_state.init = True
 
     def reset_conversation(self):
         print(f"Resetting conversation")
         st.session_state.conversation = None
         st.session_state.chat_history = None
+        st.session_state.chat_renderer.clear()
         st.session_state.gcs_blob = None
+        if st.session_state.ingest_job_id is not None:
+            get_ingest_queue().cancel(st.session_state.ingest_job_id, st.session_state.session_id)
+            st.session_state.ingest_job_id = None
+        if st.session_state.index_key is not None:
+            st.session_state.llmlibrary.release_index(st.session_state.index_key, st.session_state.session_id)
+            st.session_state.index_key = None
         st.session_state.llm = None
         st.session_state.disabled = False
         st.rerun()
@@ -35,23 +47,122 @@ class TF_ASSISTANT():
     def handle_userinput(self, question):
         if "conversation" not in st.session_state or st.session_state["conversation"] is None:
             st.session_state.conversation = st.session_state.llmlibrary.ask()
-        response = st.session_state.conversation({'question': question})
+        # Earlier turns are already on the page, only the new question and the streamed answer are written
+        renderer = st.session_state.chat_renderer
+        index = len(st.session_state.chat_history or [])
+        st.write(renderer.message_html(index, question), unsafe_allow_html=True)
+        print(f"User Message: {question}")
+        placeholder = st.empty()
+        handler = StreamlitTokenHandler(placeholder, bot_template)
+        telemetry = get_telemetry()
+        with telemetry.span("chat_turn", llm=st.session_state.llm) as span:
+            response = st.session_state.conversation({'question': question}, callbacks=[handler])
         #print(f"Response: {response}")
-        st.session_state.chat_history = response['chat_history']
-
-        for i, message in enumerate(st.session_state.chat_history):
-            if i % 2 == 0:
-                st.write(user_template.replace(
-                    "{{MSG}}", message.content), unsafe_allow_html=True)
-                print(f"User Message: {message.content}")
-            else:
-                st.write(bot_template.replace(
-                    "{{MSG}}", message.content), unsafe_allow_html=True)
-                print(f"Bot Message: {message.content}")
+        placeholder.write(renderer.message_html(index + 1, response['answer']), unsafe_allow_html=True)
+        print(f"Bot Message: {response['answer']}")
+        # The memory only holds a window and a summary, the page keeps the full transcript
+        st.session_state.chat_history = (st.session_state.chat_history or []) + [
+            HumanMessage(content=question),
+            AIMessage(content=response['answer']),
+        ]
+
+        metrics = handler.metrics(response['answer'])
+        metrics['prompt_tokens'] = response.get('prompt_tokens')
+        metrics['context_tokens'] = response.get('context_tokens')
+        metrics['cached'] = response.get('cached', False)
+        metrics['inventory'] = response.get('inventory', False)
+        st.session_state.turn_metrics.append(metrics)
+        span.set(**metrics)
+        telemetry.observe("time_to_first_token", metrics['time_to_first_token'])
+        telemetry.increment("chat_turns_total", llm=st.session_state.llm, cached=str(metrics['cached']).lower())
+        telemetry.increment("prompt_tokens_total", metrics['prompt_tokens'] or 0, llm=st.session_state.llm)
+        telemetry.increment("completion_tokens_total", metrics['completion_tokens'], llm=st.session_state.llm)
+        print(f"Time to first token: {metrics['time_to_first_token']:.2f}s, tokens/sec: {metrics['tokens_per_second'] or 0:.1f}, prompt tokens: {metrics['prompt_tokens']}, context tokens: {metrics['context_tokens']}, cached: {metrics['cached']}, inventory: {metrics['inventory']}")
         
     def disable_upload(self):
         st.session_state.disabled = True
 
+    def submit_ingest(self, terraform_state_path):
+        # Download, parse and embed in a background worker so the page stays responsive
+        session_id = st.session_state.session_id
+        job = get_ingest_queue().submit(
+            terraform_state_path.strip(),
+            # Each job gets its own reader and working index, the clients underneath are pooled
+            lambda job: TerraformReader().get_tf_states(terraform_state_path.strip(), session_id, progress_callback=job.report, warning_callback=job.warn),
+            session_id,
+        )
+        st.session_state.ingest_job_id = job.job_id
+
+    def poll_ingest(self):
+        # Returns True while this session's ingest job is still running
+        job = get_ingest_queue().get(st.session_state.ingest_job_id)
+        if job is None:
+            st.session_state.ingest_job_id = None
+            return False
+        if not job.done:
+            st.progress(job.progress, text=f"{job.status.capitalize()}: {job.message}")
+            if st.button("Cancel upload"):
+                # Other sessions may have joined the same job, so this only detaches this session from it
+                get_ingest_queue().cancel(job.job_id, st.session_state.session_id)
+                st.session_state.ingest_job_id = None
+                st.session_state.disabled = False
+                st.warning(f"Ingest of {job.path} was cancelled")
+                return False
+            return True
+        st.session_state.ingest_job_id = None
+        if job.warnings:
+            st.warning("\n".join(f"- {warning}" for warning in job.warnings))
+        if job.status == READY:
+            self.use_index(job.index_key)
+        elif job.status == FAILED:
+            st.error(f"Unable to load the Terraform state: {job.error}")
+            st.session_state.disabled = False
+        else:
+            st.warning(job.message)
+            st.session_state.disabled = False
+        return False
+
+    def show_diagnostics(self):
+        # Hidden panel, opened with ?diagnostics=1 in the URL or DIAGNOSTICS_PANEL=true
+        telemetry = get_telemetry()
+        with st.expander("Diagnostics"):
+            st.caption("Stage latency")
+            st.dataframe(telemetry.stage_summary(), use_container_width=True)
+            st.caption("Recent spans")
+            st.dataframe(
+                [dict(span, attributes=json.dumps(span["attributes"], default=str)) for span in telemetry.recent_spans(50)],
+                use_container_width=True,
+            )
+            st.caption("Caches and indexes")
+            answer_cache = get_answer_cache()
+            st.json({
+                "vector_registry": get_registry().stats(),
+                # Ingests embed on the job's worker, not this session, so the counts are the process-wide ones
+                "embedding_cache": {
+                    "hits": int(telemetry.counter("embedding_cache_hits_total")),
+                    "misses": int(telemetry.counter("embedding_cache_misses_total")),
+                },
+                "answer_cache": answer_cache.stats() if answer_cache is not None else None,
+            })
+            st.caption("This session's turns")
+            st.dataframe(st.session_state.turn_metrics, use_container_width=True)
+            st.caption("Prometheus metrics")
+            st.code(telemetry.prometheus(), language="text")
+
+    def use_index(self, index_key):
+        session_id = st.session_state.session_id
+        # Sessions that joined another session's job take their own reference here
+        if st.session_state.llmlibrary.use_index(index_key, session_id) is None:
+            st.error("The Terraform state index is no longer available, please submit it again.")
+            st.session_state.disabled = False
+            return
+        if index_key != st.session_state.index_key:
+            if st.session_state.index_key is not None:
+                st.session_state.llmlibrary.release_index(st.session_state.index_key, session_id)
+            st.session_state.index_key = index_key
+            st.session_state.conversation = None
+        st.success("Terraform state is ready, ask away!")
+
 
 def main():
 # Streamlit Code
@@ -69,10 +180,16 @@ def main():
         st.session_state.gcs_blob = None
     if "index" not in st.session_state:
         st.session_state.index = None
+    if "index_key" not in st.session_state:
+        st.session_state.index_key = None
+    if "turn_metrics" not in st.session_state:
+        st.session_state.turn_metrics = []
+    if "ingest_job_id" not in st.session_state:
+        st.session_state.ingest_job_id = None
     if "disabled" not in st.session_state:
         st.session_state.disabled = False
-    if 'message_placeholders' not in st.session_state:
-        st.session_state.message_placeholders = []
+    if "chat_renderer" not in st.session_state:
+        st.session_state.chat_renderer = ChatRenderer(user_template, bot_template, int(os.getenv("CHAT_PAGE_SIZE", "20")))
     if "file_processed" not in st.session_state:
         st.session_state.file_processed = False
     if "llm" not in st.session_state:
@@ -81,20 +198,8 @@ def main():
 
 
     if st.session_state.chat_history is not None:
-        # Iterate over the chat history and display each message
-        for i, message in enumerate(st.session_state.chat_history):
-            # Ensure there's a placeholder for each message
-            if len(st.session_state.message_placeholders) <= i:
-                st.session_state.message_placeholders.append(st.empty())
-            
-            # Decide which template to use based on whether it's a user or bot message
-            template = user_template if i % 2 == 0 else bot_template
-            # Update the corresponding placeholder with the message
-            st.session_state.message_placeholders[i].write(template.replace("{{MSG}}", message.content), unsafe_allow_html=True)
-        
-        template = user_template if i % 2 == 0 else bot_template
-        st.session_state.message_placeholders[i].write(template.replace("{{MSG}}", message.content), unsafe_allow_html=True)
-   
+        st.session_state.chat_renderer.render(st.session_state.chat_history)
+
     if question := st.chat_input("Ask a questions:"):
         if st.session_state.llm is not None:
             tf_assist.handle_userinput(question)
@@ -106,11 +211,12 @@ def main():
 # Side bar code
     with st.sidebar:
         with st.form("Terraform State Upload"):
-            terraform_state_path = st.text_input("Terraform GCS path starts with gs:// ends with .tfstate:", key = "terraform_state_path")
+            terraform_state_path = st.text_input("Terraform GCS path: a gs:// .tfstate file, a prefix or a glob such as gs://bucket/envs/*/default.tfstate", key = "terraform_state_path")
             submit_button = st.form_submit_button(label='Submit', on_click=tf_assist.disable_upload, disabled=st.session_state.disabled)
             if submit_button:
                 st.info("File Uploaded: "+ st.session_state.terraform_state_path)
-                st.session_state.terraformreader.get_tf_state(st.session_state.terraform_state_path)
+                tf_assist.submit_ingest(st.session_state.terraform_state_path)
+        ingest_running = st.session_state.ingest_job_id is not None and tf_assist.poll_ingest()
         # Reset Chat button
         if st.button("Reset Chat"):
             tf_assist.reset_conversation()
@@ -129,7 +235,13 @@ def main():
             st.session_state.llm = "openai"
         else:
             st.session_state.llm = None
+        if os.getenv("DIAGNOSTICS_PANEL", "false").lower() == "true" or "diagnostics" in st.experimental_get_query_params():
+            tf_assist.show_diagnostics()
 
+    # Poll the background ingest until it finishes
+    if ingest_running:
+        time.sleep(1)
+        st.rerun()
 
 if __name__ == "__main__":
     tf_assist = TF_ASSISTANT()
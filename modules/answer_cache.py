@@ -0,0 +1,110 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+
+def normalize_question(question):
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip("?.! ")
+
+
+class CachedAnswer():
+    def __init__(self, question, vector, answer, source_documents):
+        self.question = question
+        self.vector = vector
+        self.answer = answer
+        self.source_documents = source_documents
+        self.created = time.time()
+
+
+class AnswerCache():
+    def __init__(self, threshold=0.95, ttl_seconds=86400, max_entries=1000):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # (scope, normalized question) -> CachedAnswer, least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def embed(self, embeddings, question):
+        vector = np.asarray(embeddings.embed_query(normalize_question(question)), dtype="float32")
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def get_exact(self, scope, question):
+        # Repeats of the same question are answered without embedding it
+        key = (scope, normalize_question(question))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and not self.expired(entry):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        return None
+
+    def lookup(self, scope, vector):
+        with self.lock:
+            self.prune()
+            best_key, best_score = None, self.threshold
+            for key, entry in self.entries.items():
+                if key[0] != scope:
+                    continue
+                score = float(np.dot(vector, entry.vector))
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(best_key)
+            self.hits += 1
+            print(f"Answer cache hit with similarity {best_score:.3f}")
+            return self.entries[best_key]
+
+    def put(self, scope, question, vector, answer, source_documents):
+        key = (scope, normalize_question(question))
+        with self.lock:
+            self.entries[key] = CachedAnswer(question, vector, answer, source_documents)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def expired(self, entry):
+        return self.ttl_seconds > 0 and time.time() - entry.created > self.ttl_seconds
+
+    def prune(self):
+        for key in [key for key, entry in self.entries.items() if self.expired(entry)]:
+            del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+def get_answer_cache():
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            max_entries = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+            if max_entries <= 0:
+                return None
+            _answer_cache = AnswerCache(
+                threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+                ttl_seconds=int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400")),
+                max_entries=max_entries,
+            )
+        return _answer_cache
@@ -0,0 +1,45 @@
+import math
+import streamlit as st
+
+
+
+class ChatRenderer():
+    def __init__(self, user_template, bot_template, page_size=20):
+        self.user_template = user_template
+        self.bot_template = bot_template
+        self.page_size = page_size
+        # message index -> (hash of the content, templated HTML)
+        self.html_cache = {}
+
+    def clear(self):
+        self.html_cache = {}
+
+    def message_html(self, index, content):
+        # Templating happens once per message, later reruns reuse the cached HTML
+        content_hash = hash(content)
+        cached = self.html_cache.get(index)
+        if cached is not None and cached[0] == content_hash:
+            return cached[1]
+        template = self.user_template if index % 2 == 0 else self.bot_template
+        html = template.replace("{{MSG}}", content)
+        self.html_cache[index] = (content_hash, html)
+        return html
+
+    def render(self, messages):
+        # Only the most recent page is drawn on every rerun, older pages are drawn on request
+        total = len(messages)
+        recent_start = max(0, total - self.page_size)
+        if recent_start > 0 and st.toggle(f"Show {recent_start} earlier messages", key="show_earlier_messages"):
+            pages = math.ceil(recent_start / self.page_size)
+            page = pages
+            if pages > 1:
+                page = st.select_slider("Page", options=list(range(1, pages + 1)), value=pages, key="history_page")
+            start = (page - 1) * self.page_size
+            self.write(messages, start, min(start + self.page_size, recent_start))
+            st.divider()
+        self.write(messages, recent_start, total)
+
+    def write(self, messages, start, end):
+        # A single element for the whole window instead of one element per message
+        if start < end:
+            st.write("".join(self.message_html(i, messages[i].content) for i in range(start, end)), unsafe_allow_html=True)
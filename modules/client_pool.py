@@ -0,0 +1,49 @@
+import threading
+
+
+
+class ClientPool():
+    def __init__(self):
+        self.clients = {}
+        # One lock per key, so a slow constructor only holds up callers waiting for that same client
+        self.key_locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, provider, model, factory, **params):
+        # Clients are reused for the life of the process so their connections, auth and TLS sessions are too
+        key = (provider, model, tuple(sorted(params.items())))
+        with self.lock:
+            client = self.clients.get(key)
+            if client is not None:
+                return client
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                client = self.clients.get(key)
+            if client is None:
+                # Built outside the pool lock, a failed constructor leaves the key empty for the next caller to retry
+                print(f"Creating {provider} client for {model}")
+                client = factory()
+                with self.lock:
+                    self.clients[key] = client
+            return client
+
+
+_pool = ClientPool()
+
+def get_client_pool():
+    return _pool
+
+def get_google_credentials():
+    # Application default credentials are resolved once per process and shared by every Google client
+    import google.auth
+    return _pool.get("google-auth", "default", google.auth.default)
+
+def init_vertex_ai(project, location):
+    from google.cloud import aiplatform
+    credentials, _ = get_google_credentials()
+    return _pool.get(
+        "vertex-ai", project,
+        lambda: aiplatform.init(project=project, location=location, credentials=credentials) or True,
+        location=location,
+    )
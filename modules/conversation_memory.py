@@ -0,0 +1,116 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain.prompts import PromptTemplate
+from langchain.pydantic_v1 import Field, PrivateAttr
+from langchain.schema import SystemMessage, get_buffer_string
+from modules.token_counter import count_tokens
+
+
+
+SHORTEN_SUMMARY_PROMPT = PromptTemplate.from_template(
+    "Shorten the following summary of a conversation to at most {max_words} words, "
+    "keeping the resources, decisions and open questions it mentions.\n\n{summary}\n\nShorter summary:"
+)
+
+def truncate_tokens(text, max_tokens):
+    # Drops whole words from the end until the text fits, for when the LLM does not shorten enough
+    words = text.split()
+    while words and count_tokens(" ".join(words)) > max_tokens:
+        words = words[:len(words) * 9 // 10]
+    return " ".join(words)
+
+
+_summary_executor = None
+_summary_executor_lock = threading.Lock()
+
+def get_summary_executor():
+    global _summary_executor
+    with _summary_executor_lock:
+        if _summary_executor is None:
+            _summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+        return _summary_executor
+
+
+class WindowSummaryMemory(BaseChatMemory):
+    llm: Any
+    memory_key: str = "chat_history"
+    human_prefix: str = "Human"
+    ai_prefix: str = "AI"
+    window_turns: int = 3
+    max_token_limit: int = 1024
+    # The running summary is shortened once it grows past this, 0 means half of max_token_limit
+    summary_max_tokens: int = 0
+    summary: str = ""
+    # Number of messages rolled into the summary so far, they are dropped from chat_memory once summarised
+    summarized_count: int = 0
+    # Tokens of history handed to the chain on the most recent turns
+    prompt_tokens: Any = Field(default_factory=lambda: deque(maxlen=100))
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _pending: Any = PrivateAttr(default=None)
+    # Bumped by clear() so a summary written for the old conversation is thrown away
+    _generation: int = PrivateAttr(default=0)
+
+    @property
+    def memory_variables(self):
+        return [self.memory_key]
+
+    def load_memory_variables(self, inputs):
+        with self._lock:
+            summary = self.summary
+            recent = list(self.chat_memory.messages)
+        history = ([SystemMessage(content=summary)] if summary else []) + recent
+        tokens = count_tokens(get_buffer_string(history))
+        # Turns waiting to be summarised are dropped oldest first, the latest turn is always kept
+        while tokens > self.max_token_limit and len(recent) > 2:
+            recent = recent[2:]
+            history = ([SystemMessage(content=summary)] if summary else []) + recent
+            tokens = count_tokens(get_buffer_string(history))
+        self.prompt_tokens.append(tokens)
+        if self.return_messages:
+            return {self.memory_key: history}
+        return {self.memory_key: get_buffer_string(history, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix)}
+
+    def save_context(self, inputs, outputs):
+        super().save_context(inputs, outputs)
+        with self._lock:
+            end = len(self.chat_memory.messages) - self.window_turns * 2
+            if end <= 0 or (self._pending is not None and not self._pending.done()):
+                return
+            # The summary is written by a background worker so the next question does not wait on it
+            self._pending = get_summary_executor().submit(
+                self.summarize, self.summary, self.chat_memory.messages[:end], self._generation
+            )
+
+    def summarize(self, summary, messages, generation):
+        max_tokens = self.summary_max_tokens or self.max_token_limit // 2
+        try:
+            new_lines = get_buffer_string(messages, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix)
+            new_summary = self.llm.predict(SUMMARY_PROMPT.format(summary=summary, new_lines=new_lines)).strip()
+            if count_tokens(new_summary) > max_tokens:
+                # Roughly three words per four tokens
+                new_summary = self.llm.predict(SHORTEN_SUMMARY_PROMPT.format(max_words=max_tokens * 3 // 4, summary=new_summary)).strip()
+        except Exception as e:
+            print(f"Unable to summarise conversation: {e}")
+            return
+        new_summary = truncate_tokens(new_summary, max_tokens)
+        with self._lock:
+            # clear() may have run while the summary was being written
+            if self._generation != generation:
+                return
+            self.summary = new_summary
+            # Messages are only appended while the summary is written, so the summarised ones are still at the start
+            del self.chat_memory.messages[:len(messages)]
+            self.summarized_count += len(messages)
+        print(f"Summarised {len(messages)} messages into {count_tokens(self.summary)} tokens")
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self.summary = ""
+            self.summarized_count = 0
+            self.prompt_tokens.clear()
+            self._generation += 1
@@ -0,0 +1,169 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from langchain.schema.embeddings import Embeddings
+from modules.telemetry import get_telemetry
+
+
+
+def encode_vector(vector):
+    return array("f", vector).tobytes()
+
+def decode_vector(blob):
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+class InMemoryEmbeddingStore():
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[key] = self.entries[key]
+        return found
+
+    def set_many(self, items):
+        with self.lock:
+            for key, vector in items:
+                self.entries[key] = vector
+                self.entries.move_to_end(key)
+            # Evict the least recently used entries beyond the size bound
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class SQLiteEmbeddingStore():
+    def __init__(self, path, max_entries):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.conn.commit()
+        # Upper bound on the row count, replaced keys are counted as new until the next exact count
+        self.count = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            # Stay under SQLite's bound parameter limit
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", part
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = decode_vector(blob)
+            if found:
+                now = time.time()
+                self.conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self.conn.commit()
+        return found
+
+    def set_many(self, items):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, encode_vector(vector), now) for key, vector in items],
+            )
+            self.count += len(items)
+            if self.count > self.max_entries:
+                self.count = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if self.count > self.max_entries:
+                # Evict the least recently used entries down to 90% of the bound, so this does not run on every batch
+                excess = self.count - self.max_entries * 9 // 10
+                self.conn.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+                self.count -= excess
+            self.conn.commit()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_embedding_store():
+    # One store per process so every session shares the same cache
+    global _store
+    with _store_lock:
+        if _store is None:
+            backend = os.getenv("EMBEDDING_CACHE_BACKEND", "sqlite")
+            max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+            if backend == "sqlite":
+                path = os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite")
+                _store = SQLiteEmbeddingStore(path, max_entries)
+            elif backend == "memory":
+                _store = InMemoryEmbeddingStore(max_entries)
+            else:
+                raise ValueError(f"Unknown embedding cache backend: {backend}")
+            print(f"Embedding cache backend: {backend}")
+        return _store
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings, model_name, store):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.store = store
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def cache_key(self, text):
+        # Content addressed: the same chunk embedded by the same model always maps to the same key
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def embed_documents(self, texts):
+        keys = [self.cache_key(text) for text in texts]
+        cached = self.store.get_many(list(dict.fromkeys(keys)))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self.store.set_many(computed.items())
+            cached.update(computed)
+        with self.lock:
+            self.misses += len(missing)
+            self.hits += len(texts) - len(missing)
+        get_telemetry().increment("embedding_cache_hits_total", len(texts) - len(missing))
+        get_telemetry().increment("embedding_cache_misses_total", len(missing))
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text):
+        # Query embeddings use a different input type on most providers, so they are not cached
+        return self.embeddings.embed_query(text)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,115 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from langchain.schema.embeddings import Embeddings
+from modules.telemetry import get_telemetry
+
+
+
+class TokenBucket():
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def error_status(error):
+    # Providers expose the HTTP status under different attribute names
+    for attribute in ("http_status", "status_code", "status"):
+        status = getattr(error, attribute, None)
+        if isinstance(status, int):
+            return status
+    return None
+
+def is_rate_limited(error):
+    message = str(error).lower()
+    return error_status(error) == 429 or "429" in message or "rate limit" in message or "too many requests" in message
+
+
+class EmbeddingPipeline(Embeddings):
+    def __init__(self, embeddings, batch_size=96, max_workers=4, requests_per_minute=0, max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate_limiter = TokenBucket(requests_per_minute / 60.0, max_workers) if requests_per_minute > 0 else None
+        # Set by a worker that hit a rate limit so every worker backs off, not just the one that failed
+        self.pause_until = 0.0
+        self.lock = threading.Lock()
+        # Called with (texts embedded, texts requested) as batches complete
+        self.progress_callback = None
+
+    def embed_documents(self, texts):
+        batches = [texts[start:start + self.batch_size] for start in range(0, len(texts), self.batch_size)]
+        if len(batches) <= 1:
+            results = [self.embed_batch(batch) for batch in batches]
+            self.report_progress(len(texts), len(texts))
+        else:
+            results = [None] * len(batches)
+            done = 0
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = {pool.submit(self.embed_batch, batch): index for index, batch in enumerate(batches)}
+                for future in futures:
+                    index = futures[future]
+                    results[index] = future.result()
+                    done += len(batches[index])
+                    self.report_progress(done, len(texts))
+        return [vector for result in results for vector in result]
+
+    def embed_query(self, text):
+        return self.call_with_retry(self.embeddings.embed_query, text)
+
+    def embed_batch(self, batch):
+        return self.call_with_retry(self.embeddings.embed_documents, batch)
+
+    def call_with_retry(self, function, argument):
+        telemetry = get_telemetry()
+        for attempt in range(self.max_retries + 1):
+            self.wait_for_capacity()
+            start = time.perf_counter()
+            try:
+                result = function(argument)
+                telemetry.observe("embedding_request", time.perf_counter() - start)
+                return result
+            except Exception as e:
+                telemetry.observe("embedding_request", time.perf_counter() - start, "error")
+                status = error_status(e)
+                if attempt == self.max_retries or (status is not None and 400 <= status < 500 and status != 429):
+                    raise
+                telemetry.increment("embedding_retries_total", rate_limited=str(is_rate_limited(e)).lower())
+                # Exponential backoff with full jitter so concurrent workers do not retry in lockstep
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if is_rate_limited(e):
+                    with self.lock:
+                        self.pause_until = max(self.pause_until, time.monotonic() + delay)
+                print(f"Embedding request failed ({e}), retrying in {delay:.1f}s (attempt {attempt + 1} of {self.max_retries})")
+                time.sleep(delay)
+
+    def wait_for_capacity(self):
+        with self.lock:
+            pause = self.pause_until - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+    def report_progress(self, done, total):
+        if self.progress_callback is not None:
+            self.progress_callback(done, total)
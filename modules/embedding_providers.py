@@ -0,0 +1,60 @@
+import os
+from modules.client_pool import get_client_pool
+
+
+
+class EmbeddingProvider():
+    def __init__(self, model_id, embeddings, batch_size, max_workers, requests_per_minute=0, max_retries=0):
+        # model_id keys the embedding cache and persisted indexes, vectors from different models never mix
+        self.model_id = model_id
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.requests_per_minute = requests_per_minute
+        self.max_retries = max_retries
+
+
+def cohere_provider():
+    from langchain.embeddings.cohere import CohereEmbeddings
+    model = os.getenv("COHERE_EMBEDDING_MODEL", "embed-english-v3.0")
+    cohere_api_key = os.getenv("COHERE_API_KEY")
+    embeddings = get_client_pool().get(
+        "cohere", model,
+        lambda: CohereEmbeddings(model=model, cohere_api_key=cohere_api_key),
+    )
+    return EmbeddingProvider(
+        f"cohere/{model}",
+        embeddings,
+        batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", "96")),
+        max_workers=int(os.getenv("EMBEDDING_MAX_WORKERS", "4")),
+        requests_per_minute=int(os.getenv("EMBEDDING_REQUESTS_PER_MINUTE", "0")),
+        max_retries=int(os.getenv("EMBEDDING_MAX_RETRIES", "5")),
+    )
+
+def local_provider():
+    # sentence-transformers is only imported when the local provider is selected
+    from langchain.embeddings import HuggingFaceEmbeddings
+    model = os.getenv("LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+    batch_size = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", "64"))
+    embeddings = get_client_pool().get(
+        "sentence-transformers", model,
+        lambda: HuggingFaceEmbeddings(
+            model_name=model,
+            model_kwargs={"device": "cpu"},
+            encode_kwargs={"batch_size": batch_size, "normalize_embeddings": True},
+        ),
+    )
+    # The model already vectorises each batch across CPU cores, more threads would only contend
+    return EmbeddingProvider(f"local/{model}", embeddings, batch_size=batch_size * 4, max_workers=1)
+
+
+EMBEDDING_PROVIDERS = {
+    "cohere": cohere_provider,
+    "local": local_provider,
+}
+
+def get_embedding_provider(name=None):
+    name = name or os.getenv("EMBEDDING_PROVIDER", "cohere")
+    if name not in EMBEDDING_PROVIDERS:
+        raise ValueError(f"Unknown embedding provider: {name}")
+    return EMBEDDING_PROVIDERS[name]()
@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+QUEUED = "queued"
+DOWNLOADING = "downloading"
+EMBEDDING = "embedding"
+READY = "ready"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (READY, FAILED, CANCELLED)
+
+
+class IngestCancelled(Exception):
+    pass
+
+
+class IngestJob():
+    def __init__(self, path):
+        self.job_id = uuid.uuid4().hex
+        self.path = path
+        self.status = QUEUED
+        self.progress = 0.0
+        self.message = "Waiting for a worker"
+        self.error = None
+        # Problems that did not fail the job, e.g. states of a prefix that could not be indexed
+        self.warnings = []
+        self.index_key = None
+        self.created = time.time()
+        self.finished = None
+        self.cancel_event = threading.Event()
+        # Sessions waiting on this job, it is only cancelled once none of them want it any more
+        self.subscribers = set()
+
+    @property
+    def done(self):
+        return self.status in FINISHED
+
+    def report(self, status, fraction, message):
+        # Used as the reader's progress callback, which makes it the cancellation point too
+        if self.cancel_event.is_set():
+            raise IngestCancelled(f"Ingest of {self.path} was cancelled")
+        if status is not None:
+            self.status = status
+        self.progress = fraction
+        self.message = message
+
+    def warn(self, message):
+        self.warnings.append(message)
+
+
+class IngestJobQueue():
+    def __init__(self, max_workers, retention_seconds):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self.retention_seconds = retention_seconds
+        self.jobs = {}
+        # path -> job still in flight for it, so identical submissions share one job
+        self.active = {}
+        self.lock = threading.Lock()
+
+    def submit(self, path, run, subscriber):
+        with self.lock:
+            self.prune()
+            job = self.active.get(path)
+            if job is not None and not job.done and not job.cancel_event.is_set():
+                print(f"Joining ingest job {job.job_id} already running for {path}")
+                job.subscribers.add(subscriber)
+                return job
+            job = IngestJob(path)
+            job.subscribers.add(subscriber)
+            self.jobs[job.job_id] = job
+            self.active[path] = job
+        print(f"Queued ingest job {job.job_id} for {path}")
+        self.executor.submit(self.run_job, job, run)
+        return job
+
+    def run_job(self, job, run):
+        try:
+            if job.cancel_event.is_set():
+                raise IngestCancelled(f"Ingest of {job.path} was cancelled")
+            job.status = DOWNLOADING
+            job.index_key = run(job)
+            job.progress = 1.0
+            job.message = "Terraform state indexed"
+            job.status = READY
+        except IngestCancelled as e:
+            print(e)
+            job.message = str(e)
+            job.status = CANCELLED
+        except Exception as e:
+            print(f"Ingest job {job.job_id} failed: {e}")
+            job.error = str(e)
+            job.message = "Failed to load the Terraform state"
+            job.status = FAILED
+        finally:
+            job.finished = time.time()
+            with self.lock:
+                if self.active.get(job.path) is job:
+                    del self.active[job.path]
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id, subscriber):
+        # Unsubscribes the session, the job itself is cancelled when it was the last one waiting on it
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.done:
+                return
+            job.subscribers.discard(subscriber)
+            if job.subscribers:
+                print(f"Left ingest job {job_id}, {len(job.subscribers)} sessions still waiting on it")
+                return
+            print(f"Cancelling ingest job {job_id}")
+            job.cancel_event.set()
+
+    def prune(self):
+        # Called with the lock held
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.done and now - job.finished > self.retention_seconds:
+                del self.jobs[job_id]
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_ingest_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = IngestJobQueue(
+                max_workers=int(os.getenv("INGEST_MAX_JOBS", "2")),
+                retention_seconds=int(os.getenv("INGEST_JOB_RETENTION_SECONDS", "3600")),
+            )
+        return _queue
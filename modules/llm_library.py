@@ -1,24 +1,50 @@
-import time
 import streamlit as st
 from langchain.memory import ConversationBufferMemory
-from langchain.chains import ConversationalRetrievalChain
-from langchain.prompts import (
-    ChatPromptTemplate,
-    AIMessagePromptTemplate,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-)
-from langchain.prompts import MessagesPlaceholder
-from langchain.chat_models import ChatGooglePalm
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain.prompts import ChatPromptTemplate
+import hashlib
 import os
 from dotenv import load_dotenv
-from langchain.chat_models import AzureChatOpenAI
-from langchain.embeddings.cohere import CohereEmbeddings
-from langchain.vectorstores import DocArrayInMemorySearch
-from langchain.schema.runnable import RunnableMap
-from langchain.schema.output_parser import StrOutputParser
+from modules.answer_cache import get_answer_cache
+from modules.client_pool import get_client_pool, init_vertex_ai
+from modules.conversation_memory import WindowSummaryMemory
+from modules.embedding_cache import CachedEmbeddings, get_embedding_store
+from modules.embedding_pipeline import EmbeddingPipeline
+from modules.embedding_providers import get_embedding_provider
+from modules.resource_index import AdaptiveRetriever, HybridRetriever
+from modules.retrieval_chain import TerraformRetrievalChain
+from modules.state_inventory import StateInventory
+from modules.telemetry import get_telemetry
+from modules.vector_registry import get_registry, index_key
+from modules.vector_store import (
+    create_vector_store,
+    clone_vector_store,
+    add_documents,
+    delete_documents,
+    merge_vector_stores,
+    save_vector_store,
+    load_vector_store,
+)
+
+# Tokens of retrieved context per answer model, the rest of the window is left for the prompt, history and answer
+CONTEXT_TOKEN_BUDGETS = {
+    "vertex": 12000,
+    "openai": 3000,
+}
 
+# Built once at import, every conversation chain shares it
+TERRAFORM_PROMPT = ChatPromptTemplate.from_template('''
+            You are a helpful assistant that is a DevOps Engineer. 
+            Your goal is to provide high quality Terraform code to users that are looking to deploy infrastructure on the cloud.
+            Don't use Markdown or HTML in your answers. Always start off your answer with a a gesture of kindness and a greeting.
+        State summary:
+        {state_summary}
+
+        Context:
+        {context}
+
+        Based on the context, provide a detailed terraform boilerplate and explain how it works and how to execute by using the following question: {question}
+        '''
+)
 
 
 
@@ -31,59 +57,210 @@ class LLMLibrary:
         os.environ["OPENAI_API_VERSION"] = os.getenv("OPENAI_API_VERSION")
         os.environ["OPENAI_API_BASE"] = os.getenv("OPENAI_API_BASE")
         os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
-        choere_api_key = os.getenv("COHERE_API_KEY")
-        self.embedding_function = CohereEmbeddings(model="embed-english-v3.0", cohere_api_key=choere_api_key)
+        provider = get_embedding_provider()
+        self.embedding_model = provider.model_id
+        # Requests that miss the cache are batched, sent concurrently and rate limited
+        self.embedding_pipeline = EmbeddingPipeline(
+            provider.embeddings,
+            batch_size=provider.batch_size,
+            max_workers=provider.max_workers,
+            requests_per_minute=provider.requests_per_minute,
+            max_retries=provider.max_retries,
+        )
+        # Chunks already embedded by this model are served from the cache instead of the provider
+        self.embedding_function = CachedEmbeddings(self.embedding_pipeline, self.embedding_model, get_embedding_store())
+        # Store being built by the current ingest, published to the registry once it is complete
+        self.vectorstore = None
 
     def get_llm(self):
         print(f"Loading LLM {st.session_state.llm}")
+        # LLM clients hold no per-conversation state (callbacks are passed per call), so sessions share them
+        # Provider packages are imported on first use so only the selected model's SDK is loaded
         if st.session_state.llm == "vertex":
-            return ChatGoogleGenerativeAI(model="gemini-pro",temperature=0.0)
+            from langchain_google_genai import ChatGoogleGenerativeAI
+            init_vertex_ai(os.getenv("PROJECT_ID"), "us-central1")
+            return get_client_pool().get(
+                "google-genai", "gemini-pro",
+                lambda: ChatGoogleGenerativeAI(model="gemini-pro",temperature=0.0),
+                temperature=0.0,
+            )
         elif st.session_state.llm == "openai":
-            return AzureChatOpenAI(deployment_name="gpt-4", model_name="gpt-4", temperature=0.0)
-        
+            from langchain.chat_models import AzureChatOpenAI
+            return get_client_pool().get(
+                "azure-openai", "gpt-4",
+                lambda: AzureChatOpenAI(deployment_name="gpt-4", model_name="gpt-4", temperature=0.0, streaming=True),
+                temperature=0.0, streaming=True,
+            )
+
+    def get_condense_llm(self):
+        # Rephrasing follow-up questions is a small task, so it can go to a faster model than the answer
+        model = os.getenv("CONDENSE_LLM", "")
+        if not model:
+            return None
+        print(f"Loading condense LLM {model}")
+        if model == "vertex":
+            from langchain_google_genai import ChatGoogleGenerativeAI
+            return get_client_pool().get(
+                "google-genai", "gemini-pro",
+                lambda: ChatGoogleGenerativeAI(model="gemini-pro",temperature=0.0),
+                temperature=0.0,
+            )
+        # Anything else is the name of an Azure OpenAI deployment, e.g. gpt-35-turbo
+        from langchain.chat_models import AzureChatOpenAI
+        return get_client_pool().get(
+            "azure-openai", model,
+            lambda: AzureChatOpenAI(deployment_name=model, model_name=model, temperature=0.0),
+            temperature=0.0,
+        )
+
     def faiss(self, doc_splits, blob_name):
         print("Creating Index")
-        global vectorstore
-        vectorstore = DocArrayInMemorySearch.from_documents(
-            doc_splits, 
-            embedding=self.embedding_function
-        )
+        self.vectorstore = create_vector_store(self.embedding_function)
+        return self.add_docs(doc_splits)
+
+    def checkout_index(self, entry):
+        # Published indexes may be in use by other sessions, so updates go to a private copy
+        print(f"Copying index {entry.key} for update")
+        self.vectorstore = clone_vector_store(entry.store)
+
+    def add_docs(self, doc_splits):
+        if not doc_splits:
+            return []
+        return add_documents(self.vectorstore, doc_splits)
+
+    def delete_docs(self, ids):
+        if not ids:
+            return
+        delete_documents(self.vectorstore, ids)
+
+    def get_index_entry(self, source):
+        registry = get_registry()
+        entry = registry.latest(source)
+        if entry is None:
+            # Pick up an index persisted by a previous process instead of re-embedding the state
+            with get_telemetry().span("index_load", source=source) as span:
+                store, record = load_vector_store(source, self.embedding_function)
+                span.set(found=store is not None)
+            if store is not None and record.get("embedding_model", "cohere/embed-english-v3.0") != self.embedding_model:
+                print(f"Ignoring index for {source} built with {record.get('embedding_model')}")
+                store = None
+            if store is not None:
+                entry = registry.put(index_key(source, record), source, store, record)
+        return entry
+
+    def publish_index(self, source, record, session_id):
+        record = dict(record, embedding_model=self.embedding_model)
+        key = index_key(source, record)
+        save_vector_store(self.vectorstore, source, record)
+        get_registry().put(key, source, self.vectorstore, record, session_id)
+        self.vectorstore = None
+        return key
+
+    def publish_combined_index(self, source, members, session_id):
+        # members are (workspace, index key) pairs of states already published for this session
+        # The combined index is keyed by the versions of its members, so an unchanged prefix reuses it
+        registry = get_registry()
+        digest = hashlib.sha256("\0".join(f"{workspace}={key}" for workspace, key in members).encode("utf-8")).hexdigest()[:16]
+        record = {"generation": digest, "workspaces": dict(members), "embedding_model": self.embedding_model}
+        key = index_key(source, record)
+        if registry.acquire(key, session_id) is None:
+            entries = [registry.get(member_key) for _, member_key in members]
+            print(f"Combining {len(entries)} Terraform state indexes into {key}")
+            store = merge_vector_stores([entry.store for entry in entries], [workspace for workspace, _ in members], self.embedding_function)
+            if all(entry.inventory is not None for entry in entries):
+                inventory = StateInventory.combine([(workspace, entry.inventory) for (workspace, _), entry in zip(members, entries)])
+                record["inventory"] = inventory.to_dict()
+            registry.put(key, source, store, record, session_id)
+        # The session only queries the combined index, the members stay cached until memory is needed
+        for _, member_key in members:
+            registry.release(member_key, session_id)
+        return key
+
+    def use_index(self, key, session_id):
+        if get_registry().acquire(key, session_id) is None:
+            return None
+        return key
+
+    def release_index(self, key, session_id):
+        get_registry().release(key, session_id)
+
     def ask(self):
         llm = self.get_llm()
         print(f"LLM: {llm}\n")
-        vectordb = vectorstore
+        entry = get_registry().get(st.session_state.index_key, st.session_state.session_id)
+        if entry is None:
+            raise ValueError("No Terraform state is loaded, please submit a state file")
+        vectordb = entry.store
 
-        prompt = ChatPromptTemplate.from_template('''
-            You are a helpful assistant that is a DevOps Engineer. 
-            Your goal is to provide high quality Terraform code to users that are looking to deploy infrastructure on the cloud.
-            Don't use Markdown or HTML in your answers. Always start off your answer with a a gesture of kindness and a greeting.
-        Context:
-        {context}
-
-        Based on the context, provide a detailed terraform boilerplate and explain how it works and how to execute by using the following question: {question}
-        '''
-        )
-
-        retriever = vectordb.as_retriever(
-                    search_type="similarity",
-                    search_kwargs={
-                        "k": 4,
-                        "search_distance": 0.6,
-                    },
+        retriever_type = os.getenv("RETRIEVER", "adaptive")
+        if retriever_type == "adaptive":
+            # Hybrid ranking, then as many distinct, relevant chunks as fit the model's context budget
+            context_tokens = int(os.getenv("RETRIEVER_CONTEXT_TOKENS", "0")) or CONTEXT_TOKEN_BUDGETS.get(st.session_state.llm, 3000)
+            retriever = AdaptiveRetriever(
+                store=vectordb,
+                resource_index=entry.resource_index,
+                embeddings=self.embedding_function,
+                fetch_k=int(os.getenv("RETRIEVER_FETCH_K", "20")),
+                max_candidates=int(os.getenv("RETRIEVER_MAX_CANDIDATES", "1000")),
+                min_k=int(os.getenv("RETRIEVER_MIN_K", "1")),
+                max_k=int(os.getenv("RETRIEVER_MAX_K", "12")),
+                score_threshold=float(os.getenv("RETRIEVER_SCORE_THRESHOLD", "0.3")),
+                mmr_lambda=float(os.getenv("RETRIEVER_MMR_LAMBDA", "0.7")),
+                context_tokens=context_tokens,
             )
+        elif retriever_type == "hybrid":
+            # Pre-filters on resource type, module, region and provider named in the question, then fuses BM25 and vector ranks
+            retriever = HybridRetriever(
+                store=vectordb,
+                resource_index=entry.resource_index,
+                embeddings=self.embedding_function,
+                k=int(os.getenv("RETRIEVER_K", "4")),
+                fetch_k=int(os.getenv("RETRIEVER_FETCH_K", "20")),
+                max_candidates=int(os.getenv("RETRIEVER_MAX_CANDIDATES", "1000")),
+            )
+        else:
+            retriever = vectordb.as_retriever(
+                        search_type="similarity",
+                        search_kwargs={
+                            "k": int(os.getenv("RETRIEVER_K", "4")),
+                        },
+                )
 
 
-        memory = ConversationBufferMemory(memory_key="chat_history", output_key="answer", return_messages=True, max_token_limit=1024)
+        if os.getenv("MEMORY_MODE", "summary") == "buffer":
+            memory = ConversationBufferMemory(memory_key="chat_history", output_key="answer", return_messages=True)
+        else:
+            # Recent turns are kept verbatim, older ones are rolled into a summary within a token budget
+            memory = WindowSummaryMemory(
+                llm=llm,
+                memory_key="chat_history",
+                output_key="answer",
+                return_messages=True,
+                window_turns=int(os.getenv("MEMORY_WINDOW_TURNS", "3")),
+                max_token_limit=int(os.getenv("MEMORY_MAX_TOKENS", "1024")),
+            )
         print(f"Initiating chat conversation memory\n")
         print(f"Conversation Memory: {memory}\n")
-        conversation_chain= ConversationalRetrievalChain.from_llm(
+        conversation_chain= TerraformRetrievalChain.from_llm(
             llm,
             retriever=retriever,
             memory=memory,
             rephrase_question=True,
-            combine_docs_chain_kwargs={'prompt': prompt},
+            condense_question_llm=self.get_condense_llm(),
+            condense_mode=os.getenv("CONDENSE_MODE", "auto"),
+            speculative_retrieval=os.getenv("SPECULATIVE_RETRIEVAL", "false").lower() == "true",
+            combine_docs_chain_kwargs={'prompt': TERRAFORM_PROMPT},
             return_source_documents=True,
             verbose=True,
+            # Standalone questions already answered for this state and model skip the LLM
+            answer_cache=get_answer_cache(),
+            answer_cache_scope=(entry.key, st.session_state.llm),
+            question_embeddings=self.embedding_function,
+            # Counting, listing and dependency questions are answered from the precomputed inventory without the LLM
+            inventory=entry.inventory if os.getenv("INVENTORY_FAST_PATH", "true").lower() == "true" else None,
+            resource_index=entry.resource_index,
+            inventory_list_limit=int(os.getenv("INVENTORY_LIST_LIMIT", "100")),
+            state_summary=entry.inventory.summary() if entry.inventory is not None else "",
         )
         #print(f"Conversation chain: {conversation_chain}\n")
         return conversation_chain
\ No newline at end of file
@@ -0,0 +1,275 @@
+import heapq
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Any
+import numpy as np
+from langchain.schema import BaseRetriever
+from modules.telemetry import get_telemetry
+from modules.token_counter import count_tokens
+from modules.vector_store import document_at, iter_documents, search_ids, vectors_at
+
+
+
+INDEXED_FIELDS = ("resource_type", "resource_name", "module", "provider", "region", "address", "workspace")
+
+def tokenize(text):
+    tokens = re.findall(r"[a-z0-9]+", text.lower())
+    # Crude plural folding so "buckets" matches "bucket"
+    return [token[:-1] if len(token) > 3 and token.endswith("s") and not token.endswith("ss") else token for token in tokens]
+
+# Everyday names of resource types, only used for the types present in the state
+TYPE_ALIASES = {
+    "google_compute_instance": ("vm", "vms", "virtual machine"),
+    "google_storage_bucket": ("gcs bucket",),
+    "google_container_cluster": ("gke cluster", "kubernetes cluster"),
+    "google_compute_firewall": ("firewall rule",),
+    "google_sql_database_instance": ("cloud sql instance", "sql instance"),
+    "google_pubsub_topic": ("pubsub topic", "pub sub topic"),
+    "aws_instance": ("ec2 instance", "vm", "vms"),
+    "aws_s3_bucket": ("s3 bucket",),
+}
+
+def provider_name(provider):
+    # provider["registry.terraform.io/hashicorp/google"] -> google
+    return provider.rsplit("/", 1)[-1].strip('"]').lower()
+
+
+class ResourceIndex():
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        # field -> value -> ids of the chunks with that metadata value
+        self.postings = {field: defaultdict(set) for field in INDEXED_FIELDS}
+        self.positions = {}
+        # Inverted index for BM25: term -> chunk id -> frequency of the term in that chunk
+        self.terms = defaultdict(dict)
+        self.lengths = {}
+        self.total_length = 0
+
+    @classmethod
+    def from_store(cls, store):
+        index = cls()
+        for doc_id, position, doc in iter_documents(store):
+            index.add(doc_id, position, doc)
+        return index
+
+    def add(self, doc_id, position, doc):
+        self.positions[doc_id] = position
+        for field in INDEXED_FIELDS:
+            value = doc.metadata.get(field)
+            if value:
+                self.postings[field][value].add(doc_id)
+        tokens = tokenize(doc.page_content)
+        self.lengths[doc_id] = len(tokens)
+        self.total_length += len(tokens)
+        for term, frequency in Counter(tokens).items():
+            self.terms[term][doc_id] = frequency
+
+    def detect_filters(self, question, friendly_names=False):
+        # friendly_names also matches "buckets" and "vms", which is too loose for retrieval but fine when every word is checked
+        lowered = question.lower()
+        text = f" {' '.join(tokenize(question))} "
+        workspaces = self.detect_workspaces(lowered, text)
+        addresses = self.detect_addresses(lowered)
+        if addresses:
+            return dict({"address": addresses}, **({"workspace": workspaces} if workspaces else {}))
+        filters = {}
+        modules = []
+        type_text = text
+        for module in self.postings["module"]:
+            name = " ".join(tokenize(module.rsplit(".", 1)[-1]))
+            if module.lower() in lowered or f" module {name} " in text or f" {name} module " in text:
+                modules.append(module)
+                # "module network" names the module, not google_compute_network resources
+                type_text = type_text.replace(f" module {name} ", " module ").replace(f" {name} module ", " module ")
+        types = []
+        last_words = Counter(tokenize(resource_type)[-1] for resource_type in self.postings["resource_type"])
+        for resource_type in self.postings["resource_type"]:
+            words = tokenize(resource_type)
+            # google_compute_instance matches "google compute instances" and "compute instance"
+            if f" {' '.join(words)} " in type_text or (len(words) > 1 and f" {' '.join(words[1:])} " in type_text):
+                types.append(resource_type)
+            elif friendly_names and (
+                # "buckets" when google_storage_bucket is the only kind of bucket in the state
+                (last_words[words[-1]] == 1 and f" {words[-1]} " in type_text)
+                or any(f" {' '.join(tokenize(alias))} " in type_text for alias in TYPE_ALIASES.get(resource_type, ()))
+            ):
+                types.append(resource_type)
+        if types:
+            filters["resource_type"] = types
+        if modules:
+            filters["module"] = modules
+        regions = [
+            region for region in self.postings["region"]
+            if re.search(rf"(?<![\w-]){re.escape(region)}(?![\w-])", lowered)
+        ]
+        if regions:
+            filters["region"] = regions
+        if workspaces:
+            filters["workspace"] = workspaces
+        providers = self.postings["provider"]
+        if len(providers) > 1:
+            matched = [provider for provider in providers if f" {provider_name(provider)} " in text]
+            if matched:
+                filters["provider"] = matched
+        return filters
+
+    def detect_workspaces(self, lowered, text):
+        workspaces = []
+        # Only combined indexes have workspaces, e.g. "prod/default" matches "prod/default", "prod default workspace" or "prod workspace"
+        # A part of the path only names a workspace when no other workspace shares it, unlike "default"
+        parts = Counter(" ".join(tokenize(part)) for workspace in self.postings["workspace"] for part in set(workspace.split("/")))
+        for workspace in self.postings["workspace"]:
+            names = {" ".join(tokenize(workspace))} | {name for name in (" ".join(tokenize(part)) for part in workspace.split("/")) if parts[name] == 1}
+            if re.search(rf"(?<![\w/-]){re.escape(workspace.lower())}(?![\w/-])", lowered) or any(
+                name and (f" workspace {name} " in text or f" {name} workspace " in text) for name in names
+            ):
+                workspaces.append(workspace)
+        return workspaces
+
+    def detect_addresses(self, lowered):
+        # Whole addresses only, google_storage_bucket.logs must not match module.a.google_storage_bucket.logs or ...logs_archive
+        # An instance key or attribute after the address (...logs[0], ...logs.name) still refers to the same resource
+        spans = []
+        for address in self.postings["address"]:
+            if address.lower() not in lowered:
+                continue
+            pattern = rf"(?<![\w.-]){re.escape(address.lower())}(?![\w-])"
+            spans.extend((match.start(), match.end(), address) for match in re.finditer(pattern, lowered))
+        # Where matches overlap the longest one wins
+        return list(dict.fromkeys(
+            address for start, end, address in spans
+            if not any(other_start <= start and end <= other_end and other_end - other_start > end - start for other_start, other_end, _ in spans)
+        ))
+
+    def candidates(self, filters):
+        # Values of one field are alternatives, different fields must all match
+        result = None
+        for field, values in filters.items():
+            ids = set()
+            for value in values:
+                ids |= self.postings[field].get(value, set())
+            result = ids if result is None else result & ids
+        return result
+
+    def bm25_ranking(self, question, candidates=None, limit=20):
+        # Scores every chunk that shares a term with the question, or only the candidates when filters matched
+        count = max(len(self.lengths), 1)
+        average_length = self.total_length / count or 1
+        scores = defaultdict(float)
+        for term in set(tokenize(question)):
+            postings = self.terms.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                if candidates is not None and doc_id not in candidates:
+                    continue
+                length = self.lengths[doc_id]
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / average_length))
+        return heapq.nlargest(limit, scores, key=scores.get)
+
+
+class HybridRetriever(BaseRetriever):
+    store: Any
+    resource_index: Any
+    embeddings: Any
+    k: int = 4
+    fetch_k: int = 20
+    # Filtered candidate sets up to this size are scored exactly instead of searching the whole index
+    max_candidates: int = 1000
+    rank_constant: int = 60
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        _, docs, ranking, _ = self.fused_ranking(query)
+        return [docs[doc_id] for doc_id in ranking[:self.k]]
+
+    def fused_ranking(self, query):
+        # Returns the query embedding, the candidate documents, their ids best first and their fused scores
+        telemetry = get_telemetry()
+        with telemetry.span("embed_query"):
+            embedding = np.asarray(self.embeddings.embed_query(query), dtype="float32")
+        filters = self.resource_index.detect_filters(query)
+        candidates = self.resource_index.candidates(filters) if filters else None
+        if candidates and len(candidates) <= self.max_candidates:
+            vector_ranking = self.rank_candidates(embedding, list(candidates))
+            pool = vector_ranking
+        else:
+            vector_ranking = search_ids(self.store, embedding, self.fetch_k if not candidates else self.fetch_k * 10)
+            if candidates:
+                vector_ranking = [doc_id for doc_id in vector_ranking if doc_id in candidates]
+            pool = vector_ranking[:self.fetch_k]
+        span = telemetry.current_span()
+        if span is not None:
+            span.set(filters=filters, candidates=len(candidates) if candidates else None)
+        # BM25 over the whole corpus (or the filtered candidates), so exact names the embedding missed are found too
+        lexical_ranking = self.resource_index.bm25_ranking(query, candidates or None, self.fetch_k)
+        docs = {
+            doc_id: document_at(self.store, doc_id, self.resource_index.positions.get(doc_id))
+            for doc_id in dict.fromkeys(list(pool) + lexical_ranking)
+        }
+        # Reciprocal rank fusion of the vector and BM25 rankings
+        scores = defaultdict(float)
+        for ranking in (vector_ranking[:self.fetch_k], lexical_ranking):
+            for rank, doc_id in enumerate(ranking):
+                scores[doc_id] += 1.0 / (self.rank_constant + rank + 1)
+        return embedding, docs, sorted(scores, key=scores.get, reverse=True), scores
+
+    def rank_candidates(self, embedding, ids):
+        vectors = vectors_at(self.store, [self.resource_index.positions[doc_id] for doc_id in ids])
+        norms = np.linalg.norm(vectors, axis=1) * (np.linalg.norm(embedding) or 1.0)
+        scores = vectors @ embedding / np.where(norms > 0, norms, 1.0)
+        return [ids[i] for i in np.argsort(-scores)]
+
+
+class AdaptiveRetriever(HybridRetriever):
+    # Returns between min_k and max_k chunks instead of a fixed k: the ones similar enough to the question,
+    # picked by maximal marginal relevance so near-identical chunks are not repeated, until the token budget is used
+    min_k: int = 1
+    max_k: int = 12
+    score_threshold: float = 0.3
+    mmr_lambda: float = 0.7
+    duplicate_threshold: float = 0.97
+    context_tokens: int = 3000
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        embedding, docs, ranking, scores = self.fused_ranking(query)
+        if not ranking:
+            return []
+        vectors = vectors_at(self.store, [self.resource_index.positions[doc_id] for doc_id in ranking])
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        similarity = vectors @ (embedding / (np.linalg.norm(embedding) or 1.0))
+        relevance = np.array([scores[doc_id] for doc_id in ranking])
+        relevance = relevance / relevance.max()
+
+        selected = []
+        used = 0
+        skipped = Counter()
+        remaining = list(range(len(ranking)))
+        while remaining and len(selected) < self.max_k:
+            if selected:
+                redundancy = (vectors[remaining] @ vectors[selected].T).max(axis=1)
+            else:
+                redundancy = np.zeros(len(remaining))
+            mmr = self.mmr_lambda * relevance[remaining] - (1 - self.mmr_lambda) * redundancy
+            best = int(np.argmax(mmr))
+            position = remaining.pop(best)
+            if len(selected) >= self.min_k and similarity[position] < self.score_threshold:
+                skipped["below_threshold"] += 1
+                continue
+            if redundancy[best] >= self.duplicate_threshold:
+                skipped["duplicate"] += 1
+                continue
+            tokens = count_tokens(docs[ranking[position]].page_content)
+            if selected and used + tokens > self.context_tokens:
+                skipped["over_budget"] += 1
+                continue
+            selected.append(position)
+            used += tokens
+
+        print(f"Adaptive retrieval: {len(selected)} of {len(ranking)} chunks, {used} tokens, skipped {dict(skipped)}")
+        span = get_telemetry().current_span()
+        if span is not None:
+            span.set(selected=len(selected), pool=len(ranking), packed_tokens=used, **skipped)
+        return [docs[ranking[position]] for position in selected]
@@ -0,0 +1,170 @@
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from langchain.callbacks.manager import CallbackManagerForChainRun
+from langchain.chains import ConversationalRetrievalChain
+from langchain.chains.conversational_retrieval.base import _get_chat_history
+from modules.answer_cache import normalize_question
+from modules.telemetry import get_telemetry
+from modules.token_counter import count_tokens
+
+
+
+# Words that usually point back at an earlier turn, so the question only makes sense with the history
+REFERENCE_WORDS = re.compile(
+    r"\b(it|its|that|this|these|those|them|they|their|above|previous|same|again|also|instead|one|ones)\b",
+    re.IGNORECASE,
+)
+
+# Elliptical follow-ups such as "and for the vpc?" or "what about staging" have no reference word but still need the history
+FOLLOW_UP_OPENERS = re.compile(r"^\W*(and|or|but|so|then|now|also|what about|how about|same for)\b", re.IGNORECASE)
+# Fragments this short rarely stand on their own once there is a conversation, e.g. "the vpc?" or "in us-east1"
+MIN_STANDALONE_WORDS = 4
+
+def is_standalone_question(question):
+    return (
+        REFERENCE_WORDS.search(question) is None
+        and FOLLOW_UP_OPENERS.search(question) is None
+        and len(question.split()) >= MIN_STANDALONE_WORDS
+    )
+
+
+_retrieval_executor = None
+_retrieval_executor_lock = threading.Lock()
+
+def get_retrieval_executor():
+    global _retrieval_executor
+    with _retrieval_executor_lock:
+        if _retrieval_executor is None:
+            _retrieval_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="retrieval")
+        return _retrieval_executor
+
+
+class TerraformRetrievalChain(ConversationalRetrievalChain):
+    answer_cache: Any = None
+    # (index key, model) the cached answers are valid for
+    answer_cache_scope: Any = None
+    question_embeddings: Any = None
+    # "auto" only rephrases follow-up questions that refer back to the history, "always" rephrases every follow-up
+    condense_mode: str = "always"
+    # Retrieve for the raw question while the follow-up is being rephrased, only with condense_mode "always"
+    # since "auto" only rephrases questions that change when rephrased, so the results could never be used
+    speculative_retrieval: bool = False
+    # StateInventory of the loaded state and the ResourceIndex its filters are detected with
+    inventory: Any = None
+    resource_index: Any = None
+    inventory_list_limit: int = 100
+    # Resource counts of the whole state, added to the prompt next to the retrieved chunks
+    state_summary: str = ""
+
+    def _call(self, inputs, run_manager=None):
+        _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        question = inputs["question"]
+        get_chat_history = self.get_chat_history or _get_chat_history
+        chat_history_str = get_chat_history(inputs["chat_history"])
+
+        telemetry = get_telemetry()
+        if self.inventory is not None and (not chat_history_str or is_standalone_question(question)):
+            with telemetry.span("inventory_lookup") as span:
+                answer = self.inventory.answer(question, self.resource_index, self.inventory_list_limit)
+                span.set(hit=answer is not None)
+            if answer is not None:
+                telemetry.increment("inventory_answers_total")
+                return self.inventory_output(answer, question)
+        cacheable = self.answer_cache is not None and (not chat_history_str or is_standalone_question(question))
+        question_vector = None
+        if cacheable:
+            with telemetry.span("answer_cache_lookup") as span:
+                cached = self.answer_cache.get_exact(self.answer_cache_scope, question)
+                if cached is None:
+                    question_vector = self.answer_cache.embed(self.question_embeddings, question)
+                    cached = self.answer_cache.lookup(self.answer_cache_scope, question_vector)
+                span.set(hit=cached is not None)
+            telemetry.increment("answer_cache_lookups_total", result="hit" if cached is not None else "miss")
+            print(f"Answer cache: {self.answer_cache.stats()}")
+            if cached is not None:
+                return self.cached_output(cached, question)
+        # Prompt tokens sent to the LLM this turn, across the condense and answer steps
+        prompt_tokens = 0
+
+        if chat_history_str and (self.condense_mode == "always" or not is_standalone_question(question)):
+            prompt_tokens += count_tokens(
+                self.question_generator.prompt.format(question=question, chat_history=chat_history_str)
+            )
+            speculative = None
+            if self.speculative_retrieval and self.condense_mode == "always":
+                speculative = get_retrieval_executor().submit(self._get_docs, question, inputs, run_manager=_run_manager)
+            with telemetry.span("condense", speculative=speculative is not None):
+                new_question = self.question_generator.run(
+                    question=question, chat_history=chat_history_str, callbacks=_run_manager.get_child("condense")
+                )
+            if speculative is not None and normalize_question(new_question) == normalize_question(question):
+                docs = speculative.result()
+                telemetry.increment("speculative_retrievals_total", result="used")
+            else:
+                if speculative is not None:
+                    telemetry.increment("speculative_retrievals_total", result="discarded")
+                docs = self._get_docs(new_question, inputs, run_manager=_run_manager)
+        else:
+            new_question = question
+            docs = self._get_docs(new_question, inputs, run_manager=_run_manager)
+        output = {}
+        if self.response_if_no_docs_found is not None and len(docs) == 0:
+            output[self.output_key] = self.response_if_no_docs_found
+        else:
+            new_inputs = inputs.copy()
+            if self.rephrase_question:
+                new_inputs["question"] = new_question
+            new_inputs["chat_history"] = chat_history_str
+            new_inputs["state_summary"] = self.state_summary or "Not available"
+            with telemetry.span("answer", documents=len(docs)) as span:
+                output[self.output_key], answer_tokens = self.stream_answer(docs, new_inputs, _run_manager)
+                span.set(prompt_tokens=answer_tokens, completion_tokens=count_tokens(output[self.output_key]))
+            prompt_tokens += answer_tokens
+            if question_vector is not None:
+                self.answer_cache.put(self.answer_cache_scope, question, question_vector, output[self.output_key], docs)
+
+        if self.return_source_documents:
+            output["source_documents"] = docs
+        if self.return_generated_question:
+            output["generated_question"] = new_question
+        output["prompt_tokens"] = prompt_tokens
+        output["context_tokens"] = sum(count_tokens(doc.page_content) for doc in docs)
+        output["cached"] = False
+        output["inventory"] = False
+        return output
+
+    def _get_docs(self, question, inputs, *, run_manager):
+        with get_telemetry().span("retrieval") as span:
+            docs = super()._get_docs(question, inputs, run_manager=run_manager)
+            span.set(documents=len(docs), context_tokens=sum(count_tokens(doc.page_content) for doc in docs))
+            return docs
+
+    def cached_output(self, cached, question):
+        output = {self.output_key: cached.answer, "prompt_tokens": 0, "context_tokens": 0, "cached": True, "inventory": False}
+        if self.return_source_documents:
+            output["source_documents"] = cached.source_documents
+        if self.return_generated_question:
+            output["generated_question"] = question
+        return output
+
+    def inventory_output(self, answer, question):
+        output = {self.output_key: answer, "prompt_tokens": 0, "context_tokens": 0, "cached": False, "inventory": True}
+        if self.return_source_documents:
+            output["source_documents"] = []
+        if self.return_generated_question:
+            output["generated_question"] = question
+        return output
+
+    def stream_answer(self, docs, inputs, run_manager):
+        # Stream the answer so callbacks tagged "answer" receive tokens as they are generated
+        llm_chain = self.combine_docs_chain.llm_chain
+        chain_inputs = self.combine_docs_chain._get_inputs(docs, **inputs)
+        prompt_value = llm_chain.prompt.format_prompt(
+            **{key: chain_inputs[key] for key in llm_chain.prompt.input_variables}
+        )
+        answer = ""
+        for chunk in llm_chain.llm.stream(prompt_value, config={"callbacks": run_manager.get_child(), "tags": ["answer"]}):
+            answer += chunk.content
+        return answer, count_tokens(prompt_value.to_string())
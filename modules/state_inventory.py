@@ -0,0 +1,191 @@
+import re
+from collections import Counter, defaultdict
+from modules.tfstate_resources import instance_region, resource_metadata
+from modules.resource_index import TYPE_ALIASES, provider_name, tokenize
+
+
+
+# Fields counted for the summary, in the order they are listed
+SUMMARY_FIELDS = ("resource_type", "module", "provider", "region", "workspace")
+
+COUNT_QUESTION = re.compile(r"\b(how many|count|number of)\b", re.IGNORECASE)
+# Only questions that open with a listing verb, "show all details" in the middle of a question is not a list request
+LIST_QUESTION = re.compile(r"^\W*(please\s+|can you\s+)?(list|enumerate|show|which|what|give me)\b", re.IGNORECASE)
+DEPENDENCY_QUESTION = re.compile(r"\bdepend(s|ed|ing|ency|encies|ent|ents)?\b", re.IGNORECASE)
+DEPENDENTS_QUESTION = re.compile(r"\b(what|which)( resources?)? depends? on\b|\bdependents\b", re.IGNORECASE)
+SUMMARY_QUESTION = re.compile(r"\b(summari[sz]e|summary|overview)\b|\bwhat('s| is) in (the|my|this) state\b", re.IGNORECASE)
+# Asking for code, a fix or an explanation needs the LLM even if the question also counts or lists something
+GENERATION_QUESTION = re.compile(r"\b(terraform code|boilerplate|write|generate|create|deploy|explain|why|how (do|can|should|to))\b", re.IGNORECASE)
+# Words that carry no constraint, every other word of a question has to be covered by a detected filter
+FILLER_WORDS = set(tokenize(
+    "how many count number of list enumerate show give tell me please can you which what whats is are was there "
+    "do does i we have has my our the a an in on at from across with and or all every each any "
+    "resources resource types type module modules region regions workspace workspaces provider providers "
+    "state states currently exist exists managed total this these those it s "
+    "depend depends depending dependency dependencies dependent dependents "
+    "summary summarize summarise overview"
+))
+
+
+class StateInventory():
+    def __init__(self):
+        # (workspace, address) -> type, name, module, provider, region, mode, instances and dependencies of one resource
+        self.resources = {}
+        self.counts = {field: Counter() for field in SUMMARY_FIELDS}
+        # (workspace, address) -> addresses in that workspace of the resources that depend on it
+        self.dependents = defaultdict(set)
+
+    def add(self, resource, address, workspace=""):
+        instances = resource.get("instances") or [{}]
+        dependencies = sorted({dependency for instance in instances for dependency in instance.get("dependencies") or []})
+        self.add_entry(dict(
+            resource_metadata(resource),
+            address=address,
+            region=instance_region(instances[0]),
+            instances=len(resource.get("instances") or []),
+            dependencies=dependencies,
+            workspace=workspace,
+        ))
+
+    def add_entry(self, entry):
+        workspace = entry.get("workspace", "")
+        self.resources[(workspace, entry["address"])] = entry
+        for field in SUMMARY_FIELDS:
+            if entry.get(field):
+                self.counts[field][entry[field]] += 1
+        # Dependencies always point at resources of the same state
+        for dependency in entry["dependencies"]:
+            self.dependents[(workspace, dependency)].add(entry["address"])
+
+    def to_dict(self):
+        # Stored in the index record, the counts and reverse dependencies are rebuilt on load
+        return {"resources": list(self.resources.values())}
+
+    @classmethod
+    def from_dict(cls, data):
+        if not data:
+            return None
+        inventory = cls()
+        for entry in data["resources"]:
+            inventory.add_entry(entry)
+        return inventory
+
+    @classmethod
+    def combine(cls, parts):
+        # parts are (workspace, inventory) pairs of the states of one prefix
+        inventory = cls()
+        for workspace, part in parts:
+            for entry in part.resources.values():
+                inventory.add_entry(dict(entry, workspace=workspace))
+        return inventory
+
+    @property
+    def workspaces(self):
+        return list(self.counts["workspace"])
+
+    def matching(self, filters):
+        # Filters come from ResourceIndex.detect_filters, values of one field are alternatives
+        return [
+            entry for entry in self.resources.values()
+            if all(entry.get(field) in values for field, values in filters.items())
+        ]
+
+    def summary(self, max_items=10):
+        # A few lines for the prompt, so the LLM knows the shape of the whole state and not only the retrieved chunks
+        lines = [f"{plural(len(self.resources), 'resource')} with {plural(sum(entry['instances'] for entry in self.resources.values()), 'instance')}."]
+        for field in SUMMARY_FIELDS:
+            counts = self.counts[field]
+            if not counts:
+                continue
+            label = provider_name if field == "provider" else str
+            items = ", ".join(f"{label(value)} ({count})" for value, count in counts.most_common(max_items))
+            if len(counts) > max_items:
+                items += f", and {len(counts) - max_items} more"
+            lines.append(f"{field.replace('_', ' ').capitalize()}s: {items}.")
+        return "\n".join(lines)
+
+    def unresolved_words(self, question, filters):
+        # Words of the question no filter accounts for, e.g. "nodes", "port 22" or "postgres"
+        resolved = set(FILLER_WORDS)
+        for provider in self.counts["provider"]:
+            resolved.update(tokenize(provider_name(provider)))
+        for field, values in filters.items():
+            for value in values:
+                resolved.update(tokenize(provider_name(value) if field == "provider" else value))
+                if field == "resource_type":
+                    resolved.update(word for alias in TYPE_ALIASES.get(value, ()) for word in tokenize(alias))
+        return [word for word in tokenize(question) if word not in resolved]
+
+    def answer(self, question, resource_index, list_limit=100):
+        # Returns an answer for counting, listing, dependency and summary questions, None for anything else
+        if GENERATION_QUESTION.search(question):
+            return None
+        filters = resource_index.detect_filters(question, friendly_names=True)
+        unresolved = self.unresolved_words(question, filters)
+        if unresolved:
+            print(f"Inventory: not answering, no filter for {unresolved}")
+            return None
+        if len(self.workspaces) > 1 and "workspace" not in filters:
+            # Each workspace is a separate deployment, an answer across all of them is rarely what was meant
+            print("Inventory: not answering, the question does not name a workspace")
+            return None
+        described = describe_filters(filters)
+        if "address" in filters:
+            # Anything else about one resource, e.g. its region or settings, is answered from its chunks by the LLM
+            return self.dependency_answer(question, filters, list_limit) if DEPENDENCY_QUESTION.search(question) else None
+        # A count or list needs something to count: a type or module, or "resources" for all of them
+        scoped = any(field in filters for field in ("resource_type", "module")) or "resource" in tokenize(question)
+        if COUNT_QUESTION.search(question) and scoped:
+            matched = self.matching(filters)
+            instances = sum(entry["instances"] for entry in matched)
+            lines = [f"There {'is' if len(matched) == 1 else 'are'} {plural(len(matched), 'resource')}{described} ({plural(instances, 'instance')})."]
+            by_type = Counter(entry["resource_type"] for entry in matched)
+            if len(by_type) > 1:
+                lines.extend(f"- {resource_type}: {count}" for resource_type, count in by_type.most_common(list_limit))
+            return "\n".join(lines)
+        if SUMMARY_QUESTION.search(question) and not filters:
+            return self.summary(max_items=list_limit)
+        if LIST_QUESTION.search(question) and scoped:
+            matched = sorted(self.matching(filters), key=lambda entry: (entry.get("workspace", ""), entry["address"]))
+            lines = [f"{plural(len(matched), 'resource')}{described}" + (":" if matched else ".")]
+            for entry in matched[:list_limit]:
+                prefix = f"[{entry['workspace']}] " if entry.get("workspace") else ""
+                lines.append(f"- {prefix}{entry['address']}" + (f" ({entry['region']})" if entry.get("region") else ""))
+            if len(matched) > list_limit:
+                lines.append(f"... and {len(matched) - list_limit} more")
+            return "\n".join(lines)
+        return None
+
+    def dependency_answer(self, question, filters, list_limit):
+        lines = []
+        for workspace in filters.get("workspace") or self.workspaces or [""]:
+            prefix = f"[{workspace}] " if workspace else ""
+            for address in filters["address"]:
+                entry = self.resources.get((workspace, address))
+                if entry is None:
+                    continue
+                if DEPENDENTS_QUESTION.search(question):
+                    related = sorted(self.dependents.get((workspace, address), ()))
+                    verb = "depends" if len(related) == 1 else "depend"
+                    lines.append(f"{prefix}{plural(len(related), 'resource')} {verb} on {address}" + (":" if related else "."))
+                else:
+                    related = entry["dependencies"]
+                    lines.append(f"{prefix}{address} depends on {plural(len(related), 'resource')}" + (":" if related else "."))
+                lines.extend(f"- {item}" for item in related[:list_limit])
+                if len(related) > list_limit:
+                    lines.append(f"... and {len(related) - list_limit} more")
+        return "\n".join(lines) or None
+
+
+def plural(count, word):
+    return f"{count} {word}" + ("" if count == 1 else "s")
+
+
+def describe_filters(filters):
+    parts = []
+    for field, values in filters.items():
+        label = {"resource_type": "of type", "module": "in", "region": "in region", "provider": "from provider", "workspace": "in workspace", "address": "at"}.get(field, field)
+        if field == "provider":
+            values = [provider_name(value) for value in values]
+        parts.append(f"{label} {' or '.join(values)}")
+    return (" " + ", ".join(parts)) if parts else ""
@@ -0,0 +1,49 @@
+import time
+from langchain.callbacks.base import BaseCallbackHandler
+from modules.token_counter import count_tokens
+
+
+
+class StreamlitTokenHandler(BaseCallbackHandler):
+    def __init__(self, placeholder, template, refresh_seconds=0.05):
+        self.placeholder = placeholder
+        self.template = template
+        self.refresh_seconds = refresh_seconds
+        self.text = ""
+        # Only the answer step is rendered, tokens from the question rephrasing step are ignored
+        self.answer_runs = set()
+        self.started = time.monotonic()
+        self.first_token = None
+        self.finished = None
+        self.rendered = 0.0
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags=None, **kwargs):
+        if tags and "answer" in tags:
+            self.answer_runs.add(run_id)
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        if run_id not in self.answer_runs:
+            return
+        now = time.monotonic()
+        if self.first_token is None:
+            self.first_token = now
+        self.text += token
+        if now - self.rendered >= self.refresh_seconds:
+            self.rendered = now
+            self.placeholder.write(self.template.replace("{{MSG}}", self.text), unsafe_allow_html=True)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        if run_id in self.answer_runs:
+            self.finished = time.monotonic()
+
+    def metrics(self, answer):
+        finished = self.finished or time.monotonic()
+        first_token = self.first_token or finished
+        tokens = count_tokens(answer)
+        generation_seconds = finished - first_token
+        return {
+            "time_to_first_token": first_token - self.started,
+            "total_seconds": finished - self.started,
+            "completion_tokens": tokens,
+            "tokens_per_second": tokens / generation_seconds if generation_seconds > 0 else None,
+        }
@@ -0,0 +1,188 @@
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+
+# Upper bounds in seconds of the stage duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+METRIC_PREFIX = "tfassist_"
+
+
+class Span():
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "started": time.strftime("%H:%M:%S", time.localtime(self.started)),
+            "duration_ms": round(self.duration * 1000, 1) if self.duration is not None else None,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class Telemetry():
+    def __init__(self, max_spans=1000):
+        self.lock = threading.Lock()
+        self.spans = deque(maxlen=max_spans)
+        # (metric name, sorted label items) -> value
+        self.counters = defaultdict(float)
+        # (stage, status) -> [bucket counts..., +Inf count, sum]
+        self.durations = {}
+        # Spans opened on a thread become the parents of spans opened inside them
+        self.local = threading.local()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        parent = stack[-1] if stack else None
+        span = Span(name, parent.trace_id if parent else uuid.uuid4().hex[:16], parent.span_id if parent else None, attributes)
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            stack.pop()
+            span.duration = time.perf_counter() - span.start
+            self.finish(span)
+
+    def current_span(self):
+        stack = getattr(self.local, "stack", None)
+        return stack[-1] if stack else None
+
+    def finish(self, span):
+        with self.lock:
+            self.spans.append(span)
+        self.observe(span.name, span.duration, "error" if span.error else "ok")
+
+    def observe(self, stage, seconds, status="ok"):
+        # Records a duration without keeping a span, for calls too frequent to list individually
+        with self.lock:
+            histogram = self.durations.get((stage, status))
+            if histogram is None:
+                histogram = self.durations[(stage, status)] = [0] * (len(DURATION_BUCKETS) + 2)
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[len(DURATION_BUCKETS)] += 1
+            histogram[-1] += seconds
+
+    def increment(self, name, value=1, **labels):
+        if not value:
+            return
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def counter(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def recent_spans(self, limit=200):
+        with self.lock:
+            return [span.to_dict() for span in list(self.spans)[-limit:]][::-1]
+
+    def stage_summary(self):
+        with self.lock:
+            summary = []
+            for (stage, status), histogram in sorted(self.durations.items()):
+                count = histogram[len(DURATION_BUCKETS)]
+                summary.append({
+                    "stage": stage,
+                    "status": status,
+                    "count": count,
+                    "total_seconds": round(histogram[-1], 3),
+                    "mean_ms": round(histogram[-1] / count * 1000, 1) if count else 0.0,
+                })
+            return summary
+
+    def prometheus(self):
+        # Prometheus text exposition format
+        lines = []
+        with self.lock:
+            metric = f"{METRIC_PREFIX}stage_duration_seconds"
+            lines.append(f"# HELP {metric} Duration of ingest and chat stages.")
+            lines.append(f"# TYPE {metric} histogram")
+            for (stage, status), histogram in sorted(self.durations.items()):
+                labels = f'stage="{stage}",status="{status}"'
+                # Bucket counts are already cumulative, observe() counts a duration in every bucket it fits
+                for i, bound in enumerate(DURATION_BUCKETS):
+                    lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {histogram[i]}')
+                lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {histogram[len(DURATION_BUCKETS)]}')
+                lines.append(f"{metric}_sum{{{labels}}} {histogram[-1]}")
+                lines.append(f"{metric}_count{{{labels}}} {histogram[len(DURATION_BUCKETS)]}")
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                metric = f"{METRIC_PREFIX}{name}"
+                lines.append(f"# TYPE {metric} counter")
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name != name:
+                        continue
+                    label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+                    lines.append(f"{metric}{{{label_text}}} {value}" if label_text else f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port):
+        telemetry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = telemetry.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        print(f"Serving Prometheus metrics on :{port}/metrics")
+        return server
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+def get_telemetry():
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = Telemetry(max_spans=int(os.getenv("TELEMETRY_MAX_SPANS", "1000")))
+            port = int(os.getenv("TELEMETRY_PROMETHEUS_PORT", "0"))
+            if port:
+                try:
+                    _telemetry.serve(port)
+                except OSError as e:
+                    # Streamlit may re-import the app in the same process, the port is then already served
+                    print(f"Unable to serve Prometheus metrics on port {port}: {e}")
+        return _telemetry
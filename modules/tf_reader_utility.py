@@ -1,77 +1,366 @@
-from langchain.document_loaders import JSONLoader
-from langchain.document_loaders import GCSFileLoader
 from langchain.schema import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-import google.auth
-from google.cloud import storage
 from modules.llm_library import LLMLibrary
+from modules.client_pool import get_client_pool, get_google_credentials
+from modules.tfstate_resources import instance_region, resource_address, resource_fingerprint, resource_metadata
+from modules.ingest_jobs import IngestCancelled
+from modules.state_inventory import StateInventory
+from modules.telemetry import get_telemetry
+from modules.tfstate_splitter import TerraformStateSplitter
+from modules.token_counter import count_tokens
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import fnmatch
+import ijson
+import itertools
+import json
 import os
 import re
+import threading
+import time
 
 
 
+GLOB_CHARACTERS = re.compile(r"[*?\[]")
+
+def parse_gcs_path(path):
+    # gs://bucket/envs/prod.tfstate -> ("bucket", "envs/prod.tfstate"), the gs:// scheme is optional
+    match = re.fullmatch(r"(?:gs://)?([^/\s]+)(?:/(.*))?", path.strip())
+    if match is None:
+        raise ValueError(f"{path} is not a GCS path, expected gs://bucket/path")
+    return match.group(1), match.group(2) or ""
+
+def is_single_state(name):
+    return name.endswith(".tfstate") and GLOB_CHARACTERS.search(name) is None
+
+def workspace_name(name, prefix):
+    # envs/prod/default.tfstate listed under envs/ -> prod/default
+    workspace = name[len(prefix):] if name.startswith(prefix) and name != prefix else name
+    return workspace[:-len(".tfstate")].strip("/") or os.path.basename(name)
+
+
 class TerraformReader():
-    def __init__(self):
+    def __init__(self, llmlibrary=None):
         load_dotenv()
-        self.credentials, self.project = google.auth.default()
-        # Create a list of all the blobs in the Storage Bucket
+        self.credentials, self.project = get_google_credentials()
+        # Number of chunks handed to the vector store at a time while streaming
+        self.batch_size = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+        # "resource" chunks along resource/instance/attribute boundaries, "recursive" is the generic text splitter
+        self.splitter = os.getenv("TFSTATE_SPLITTER", "resource")
+        self.chunk_size = int(os.getenv("TFSTATE_CHUNK_SIZE", "1500"))
+        self.progress_callback = None
+        self.progress_status = None
+        self.progress_fraction = 0.0
+        self.progress_reported = 0.0
 
-        self.llmlibrary = LLMLibrary()
-    
-    def get_tf_state(self, terraform_state_path):
-        bucket_name = re.match(r"(?:gs://)?(.*?)/(.*)", terraform_state_path).group(1)
-        terraform_state = re.findall(r"(?:gs://)?[^/]+/(.*\.tfstate)$", terraform_state_path)[0]
-        gcs_bucket = storage.Client(project=self.project).get_bucket(bucket_name)
-        blob = gcs_bucket.blob(terraform_state)
-        blob.download_to_filename("tf_state.json")
+        self.llmlibrary = llmlibrary or LLMLibrary()
+
+    def storage_client(self):
+        from google.cloud import storage
+        return get_client_pool().get(
+            "gcs", self.project,
+            lambda: storage.Client(project=self.project, credentials=self.credentials),
+        )
+
+    def get_tf_states(self, terraform_state_path, session_id, progress_callback=None, warning_callback=None):
+        # Accepts one .tfstate, a prefix (gs://bucket/envs/) or a glob (gs://bucket/envs/*/default.tfstate)
+        # Returns the registry key of the index of the state, or of the combined index of every matching state
+        # warning_callback(message) is told about every state left out of the combined index
+        bucket_name, name = parse_gcs_path(terraform_state_path)
+        if is_single_state(name):
+            return self.get_tf_state(terraform_state_path, session_id, progress_callback)
+        self.progress_callback = progress_callback
+        self.progress_status = None
+        self.progress_fraction = 0.0
+        self.progress_reported = 0.0
+        self.report_progress(0.0, "Listing Terraform states", "downloading")
+        names = self.list_states(bucket_name, name)
+        if not names:
+            raise FileNotFoundError(f"No .tfstate files match gs://{bucket_name}/{name}")
+        print(f"Found {len(names)} Terraform states under gs://{bucket_name}/{name}")
+        prefix = GLOB_CHARACTERS.split(name, 1)[0]
+        members = self.ingest_states(bucket_name, names, prefix, session_id, warning_callback)
+        self.report_progress(0.95, f"Combining {len(members)} Terraform states", "embedding")
+        with get_telemetry().span("combine", states=len(members)):
+            index_key = self.llmlibrary.publish_combined_index(f"gs://{bucket_name}/{name}", members, session_id)
+        self.report_progress(1.0, f"{len(members)} Terraform states indexed")
+        return index_key
+
+    def list_states(self, bucket_name, pattern):
+        # Only the part before the first wildcard is sent to GCS, the rest is matched here
+        prefix = GLOB_CHARACTERS.split(pattern, 1)[0]
+        with get_telemetry().span("gcs_list", bucket=bucket_name, prefix=prefix) as span:
+            blobs = self.storage_client().list_blobs(bucket_name, prefix=prefix)
+            if GLOB_CHARACTERS.search(pattern):
+                names = [blob.name for blob in blobs if fnmatch.fnmatchcase(blob.name, pattern)]
+            else:
+                names = [blob.name for blob in blobs]
+            names = sorted(name for name in names if name.endswith(".tfstate"))
+            span.set(states=len(names))
+        return names
+
+    def ingest_states(self, bucket_name, names, prefix, session_id, warning_callback=None):
+        # Each state is indexed (or reused) on its own by a bounded pool, so one changed workspace only re-embeds itself
+        fractions = [0.0] * len(names)
+        lock = threading.Lock()
+        failed = []
+
+        def ingest(position, name):
+            def report(status, fraction, message):
+                with lock:
+                    fractions[position] = fraction
+                    self.report_progress(sum(fractions) / len(names) * 0.95, f"{sum(f >= 1.0 for f in fractions)}/{len(names)} states, {name}: {message}", status)
+            # Readers hold per-ingest state, so every state gets its own, the clients underneath are pooled
+            reader = TerraformReader(LLMLibrary())
+            try:
+                return reader.get_tf_state(f"gs://{bucket_name}/{name}", session_id, progress_callback=report)
+            except IngestCancelled:
+                raise
+            except Exception as e:
+                # The error itself is on the state's ingest span
+                get_telemetry().increment("ingest_states_failed_total")
+                with lock:
+                    failed.append((name, e))
+                return None
+            finally:
+                with lock:
+                    fractions[position] = 1.0
+
+        executor = ThreadPoolExecutor(max_workers=int(os.getenv("INGEST_STATE_WORKERS", "4")), thread_name_prefix="ingest-state")
+        try:
+            keys = list(executor.map(ingest, range(len(names)), names))
+        finally:
+            # A cancelled or failed ingest does not wait for the states still queued
+            executor.shutdown(wait=True, cancel_futures=True)
+        if failed:
+            print(f"{len(failed)} of {len(names)} Terraform states could not be indexed: {', '.join(name for name, _ in failed)}")
+            if warning_callback is not None:
+                for name, error in sorted(failed, key=lambda item: item[0]):
+                    warning_callback(f"{name} was left out: {' '.join(str(error).split())}")
+        members = [(workspace_name(name, prefix), key) for name, key in zip(names, keys) if key is not None]
+        if not members:
+            raise RuntimeError(f"None of the {len(names)} Terraform states could be indexed")
+        return members
+
+    def get_tf_state(self, terraform_state_path, session_id, progress_callback=None):
+        # Returns the registry key of the index built for the state
+        # progress_callback(status, fraction, message) may raise to abort the ingest
+        with get_telemetry().span("ingest", path=terraform_state_path) as span:
+            return self.load_tf_state(terraform_state_path, session_id, progress_callback, span)
+
+    def load_tf_state(self, terraform_state_path, session_id, progress_callback, span):
+        telemetry = get_telemetry()
+        self.progress_callback = progress_callback
+        self.progress_status = None
+        self.progress_fraction = 0.0
+        self.progress_reported = 0.0
+        self.report_progress(0.0, "Reading Terraform state metadata", "downloading")
+        bucket_name, terraform_state = parse_gcs_path(terraform_state_path)
+        if not is_single_state(terraform_state):
+            raise ValueError(f"{terraform_state_path} is not a .tfstate file")
+        storage_client = self.storage_client()
+        with telemetry.span("gcs_metadata", bucket=bucket_name):
+            gcs_bucket = storage_client.get_bucket(bucket_name)
+            blob = gcs_bucket.get_blob(terraform_state)
         print (f"Bucket: {gcs_bucket}")
         print (f"State: {terraform_state}")
 
-        TerraformReader.split_terraform(self, gcs_bucket, terraform_state)
-
-    def load_json(self, file_path):
-        return JSONLoader(file_path="tf_state.json",jq_schema='.resources[]', text_content=False)
-    
-    def split_terraform(self, gcs_bucket, terraform_state):
-           #Use get_blobs to get the new, updated, and deleted blobs        # Create a list of loaders
-        loaded_docs = ""
-        loader = ""
-        # Process new, updated, and deleted blobs
+        source = f"gs://{bucket_name}/{terraform_state}"
+        if blob is None:
+            raise FileNotFoundError(f"{source} does not exist")
+        span.set(bytes=blob.size, generation=blob.generation)
+        previous = self.llmlibrary.get_index_entry(source)
+        if previous is not None and previous.record["generation"] == blob.generation:
+            print(f"Generation {blob.generation} of {source} is already indexed, skipping")
+            span.set(outcome="unchanged")
+            telemetry.increment("ingests_total", outcome="unchanged")
+            self.report_progress(1.0, "Terraform state already indexed")
+            return self.llmlibrary.use_index(previous.key, session_id)
         try:
-            print(f"Processing blob: {terraform_state}")
-            # Create a list of loaders
-            loader = (GCSFileLoader(project_name=self.project, bucket=gcs_bucket, blob=terraform_state, loader_func=self.load_json))
-            loaded_docs = loader.load()
-            print(f"Number of TF docs :  {len(loaded_docs)}\n")
-            # Add document name and source to the metadata
-            # Split the docs
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=1000, 
-                chunk_overlap=200,
-                separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""],
-                length_function=len,
-                )
-            #print(f"Loaded Text:  {loaded_texts}\n")
-            doc_splits = text_splitter.split_documents(loaded_docs)
-            for idx, split in enumerate(doc_splits):
-                split.metadata['chunk'] = idx
-            print(f"Number of Chuncks from Terraform State:  {len(doc_splits)}\n")
-            self.embbed_docs(doc_splits, terraform_state)
+            # Read the blob once as a byte stream and hand resources downstream as they are parsed
+            with blob.open("rb") as stream:
+                header = {}
+                resources = self.stream_resources(stream, header, blob.size)
+                # Terraform writes serial and lineage before .resources[], so the header is known after the first resource
+                first = next(resources, None)
+                if previous is not None and (previous.record["lineage"], previous.record["serial"]) == (header.get("lineage"), header.get("serial")):
+                    print(f"Serial {previous.record['serial']} of {source} is already indexed, skipping")
+                    span.set(outcome="unchanged")
+                    telemetry.increment("ingests_total", outcome="unchanged")
+                    self.report_progress(1.0, "Terraform state already indexed")
+                    return self.llmlibrary.use_index(previous.key, session_id)
+                if previous is not None and previous.record["lineage"] != header.get("lineage"):
+                    print(f"Lineage of {source} changed, rebuilding the index")
+                    previous = None
+                if first is not None:
+                    resources = itertools.chain([first], resources)
+                outcome = "full" if previous is None else "incremental"
+                record = self.index_resources(resources, source, terraform_state, previous)
+            record.update({
+                "lineage": header.get("lineage"),
+                "serial": header.get("serial"),
+                "generation": blob.generation,
+            })
+            with telemetry.span("publish"):
+                index_key = self.llmlibrary.publish_index(source, record, session_id)
+            cache_stats = self.llmlibrary.embedding_function.stats()
+            span.set(
+                outcome=outcome,
+                chunks=self.split_stats["chunks"],
+                tokens=self.split_stats["tokens"],
+                embedding_cache_hits=cache_stats["hits"],
+                embedding_cache_misses=cache_stats["misses"],
+            )
+            telemetry.increment("ingests_total", outcome=outcome)
+            telemetry.increment("ingest_bytes_total", blob.size or 0)
+            telemetry.increment("ingest_chunks_total", self.split_stats["chunks"])
+            telemetry.increment("ingest_tokens_total", self.split_stats["tokens"])
+            self.report_progress(1.0, "Terraform state indexed")
+            return index_key
         except Exception as e:
             print(f"An error occurred during document loading: {e} on file {terraform_state}")
+            raise
+
+    def report_progress(self, fraction, message, status=None):
+        if self.progress_callback is None:
+            return
+        if fraction is not None:
+            self.progress_fraction = min(fraction, 1.0)
+        # Throttle updates so a large state does not flood the UI
+        now = time.monotonic()
+        if now - self.progress_reported < 0.5 and fraction != 1.0 and status in (None, self.progress_status):
+            return
+        if status is not None:
+            self.progress_status = status
+        self.progress_reported = now
+        self.progress_callback(self.progress_status, self.progress_fraction, message)
+
+    def stream_resources(self, stream, header, total_bytes):
+        # Walk the state with an event parser so only one resource is held in memory at a time
+        builder = None
+        parsed = 0
+        for prefix, event, value in ijson.parse(stream, use_float=True):
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == "resources.item" and event == "end_map":
+                    yield builder.value
+                    builder = None
+                    parsed += 1
+                    if total_bytes:
+                        self.report_progress(stream.tell() / total_bytes, f"Processed {parsed} resources")
+            elif prefix == "resources.item" and event == "start_map":
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            elif prefix in ("version", "terraform_version", "serial", "lineage"):
+                header[prefix] = value
 
+    def diff_resources(self, resources, source, old_resources, new_resources, stale_ids, inventory):
+        # Only yield resources that are new or whose content changed since the last index
+        for seq_num, resource in enumerate(resources, start=1):
+            address = resource_address(resource)
+            # The inventory covers every resource, unchanged ones included, since it is rebuilt on each ingest
+            inventory.add(resource, address)
+            fingerprint = resource_fingerprint(resource)
+            old = old_resources.get(address)
+            if old is not None and old["fingerprint"] == fingerprint:
+                new_resources[address] = old
+                continue
+            if old is not None:
+                stale_ids.extend(old["ids"])
+            new_resources[address] = {"fingerprint": fingerprint, "ids": []}
+            yield resource, {"source": source, "seq_num": seq_num, "address": address}
 
+    def index_resources(self, resources, source, terraform_state, previous):
+        if previous is None:
+            self.llmlibrary.faiss([], terraform_state)
+            old_resources = {}
+        else:
+            print(f"Incrementally updating the index of {source} from serial {previous.record['serial']}")
+            self.llmlibrary.checkout_index(previous)
+            old_resources = previous.record["resources"]
+        new_resources = {}
+        stale_ids = []
+        inventory = StateInventory()
+        changed_resources = self.diff_resources(resources, source, old_resources, new_resources, stale_ids, inventory)
+        doc_splits = self.split_terraform(changed_resources, terraform_state)
+        for address, ids in self.embbed_docs(doc_splits, terraform_state).items():
+            new_resources[address]["ids"].extend(ids)
+        removed = [address for address in old_resources if address not in new_resources]
+        for address in removed:
+            stale_ids.extend(old_resources[address]["ids"])
+        with get_telemetry().span("delete_stale", vectors=len(stale_ids)):
+            self.llmlibrary.delete_docs(stale_ids)
+        unchanged = sum(1 for address in new_resources if new_resources[address] is old_resources.get(address))
+        print(f"Resources unchanged: {unchanged}, added or changed: {len(new_resources) - unchanged}, removed: {len(removed)}")
+        return {"resources": new_resources, "inventory": inventory.to_dict()}
+    
+    def split_terraform(self, changed_resources, terraform_state):
+        print(f"Processing blob: {terraform_state}")
+        self.split_stats = {"chunks": 0, "tokens": 0}
+        if self.splitter == "resource":
+            splits = self.split_resources(changed_resources)
+        else:
+            splits = self.split_recursive(changed_resources)
+        for chunk, split in enumerate(splits):
+            split.metadata['chunk'] = chunk
+            yield split
+
+    def split_resources(self, changed_resources):
+        text_splitter = TerraformStateSplitter(chunk_size=self.chunk_size)
+        for resource, metadata in changed_resources:
+            yield from text_splitter.split_resource(resource, metadata)
+        self.split_stats = text_splitter.stats()
+
+    def split_recursive(self, changed_resources):
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=1000, 
+            chunk_overlap=200,
+            separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""],
+            length_function=len,
+            )
+        for resource, metadata in changed_resources:
+            instances = resource.get("instances") or [{}]
+            metadata = dict(metadata, region=instance_region(instances[0]), **resource_metadata(resource))
+            for split in text_splitter.split_documents([Document(page_content=json.dumps(resource), metadata=metadata)]):
+                self.split_stats["chunks"] += 1
+                self.split_stats["tokens"] += count_tokens(split.page_content)
+                yield split
+
+    def batch_docs(self, docs, batch_size):
+        batch = []
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
     
     def embbed_docs(self, docs, blob_name):
-        try:
-            if None not in (docs, blob_name):
-                #print(f"Split Text:  {docs}\n")
-                print(f"Number of Chunks from Terraform State:  {len(docs)}\n")
-                # Add the docs to the FAISS
-                print(f"Successfully loaded {blob_name}")
-                print(f"Vectorizing document {blob_name}")
-                self.llmlibrary.faiss(docs, blob_name)
-                
-        except Exception as e:
-            print(f"An error occurred during document embedding: {e} on file {blob_name}")
+        # Returns the vector ids created for each resource address
+        resource_ids = {}
+        print(f"Vectorizing document {blob_name}")
+        self.llmlibrary.embedding_function.reset_stats()
+        self.llmlibrary.embedding_pipeline.progress_callback = lambda done, requested: self.report_progress(None, f"Embedding chunks {done}/{requested}")
+        telemetry = get_telemetry()
+        total = 0
+        batches = self.batch_docs(docs, self.batch_size)
+        while True:
+            # Downloading, parsing and splitting happen lazily while the next batch is pulled
+            with telemetry.span("read_split") as span:
+                batch = next(batches, None)
+                span.set(chunks=len(batch or []))
+            if batch is None:
+                break
+            self.report_progress(None, f"Embedding {len(batch)} chunks", "embedding")
+            with telemetry.span("embed_add", chunks=len(batch)):
+                ids = self.llmlibrary.add_docs(batch)
+            for split, doc_id in zip(batch, ids):
+                resource_ids.setdefault(split.metadata["address"], []).append(doc_id)
+            total += len(batch)
+        print(f"Number of Chunks from Terraform State:  {total}\n")
+        print(f"Tokens in chunks: {self.split_stats['tokens']}")
+        cache_stats = self.llmlibrary.embedding_function.stats()
+        print(f"Embedding cache hits: {cache_stats['hits']}, misses: {cache_stats['misses']}")
+        print(f"Successfully loaded {blob_name}")
+        return resource_ids
@@ -0,0 +1,38 @@
+import hashlib
+import json
+
+
+
+def resource_address(resource):
+    # Matches the address Terraform prints, e.g. module.network.google_compute_network.vpc
+    address = f"{resource.get('type')}.{resource.get('name')}"
+    if resource.get("mode") == "data":
+        address = f"data.{address}"
+    if resource.get("module"):
+        address = f"{resource['module']}.{address}"
+    return address
+
+def resource_fingerprint(resource):
+    serialized = json.dumps(resource, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+def resource_metadata(resource):
+    return {
+        "resource_type": resource.get("type"),
+        "resource_name": resource.get("name"),
+        "mode": resource.get("mode"),
+        "module": resource.get("module", ""),
+        "provider": resource.get("provider", ""),
+    }
+
+def instance_region(instance):
+    attributes = instance.get("attributes") or {}
+    for key in ("region", "location"):
+        if isinstance(attributes.get(key), str) and attributes[key]:
+            return attributes[key].lower()
+    zone = attributes.get("zone") or attributes.get("availability_zone")
+    if isinstance(zone, str) and zone:
+        # us-central1-a -> us-central1, us-east-1a -> us-east-1
+        zone = zone.lower()
+        return zone.rsplit("-", 1)[0] if len(zone.rsplit("-", 1)[-1]) == 1 else zone[:-1]
+    return ""
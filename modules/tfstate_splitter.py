@@ -0,0 +1,91 @@
+import json
+from langchain.schema import Document
+from modules.tfstate_resources import instance_region, resource_metadata
+from modules.token_counter import count_tokens
+
+
+
+# Noisy for retrieval: kept in metadata, left out of the embedded text
+DROPPED_INSTANCE_FIELDS = ("sensitive_attributes", "private", "dependencies")
+
+
+class TerraformStateSplitter():
+    def __init__(self, chunk_size=1500):
+        self.chunk_size = chunk_size
+        self.chunks = 0
+        self.tokens = 0
+
+    def reset_stats(self):
+        self.chunks = 0
+        self.tokens = 0
+
+    def stats(self):
+        return {"chunks": self.chunks, "tokens": self.tokens}
+
+    def instance_address(self, address, instance):
+        index_key = instance.get("index_key")
+        if index_key is None:
+            return address
+        return f"{address}[{json.dumps(index_key)}]"
+
+    def attribute_lines(self, attributes, prefix=""):
+        # One line per attribute, nested maps are flattened so chunks break on attribute boundaries
+        for key, value in (attributes or {}).items():
+            if isinstance(value, dict) and value:
+                yield from self.attribute_lines(value, f"{prefix}{key}.")
+            elif value is None or value == [] or value == {} or value == "":
+                continue
+            else:
+                yield f"{prefix}{key} = {json.dumps(value, separators=(',', ':'))}"
+
+    def split_resource(self, resource, metadata):
+        address = metadata["address"]
+        base_metadata = dict(metadata, **resource_metadata(resource))
+        for instance in resource.get("instances", []):
+            instance_address = self.instance_address(address, instance)
+            header = (
+                f"resource: {instance_address}\n"
+                f"type: {resource.get('type')}\n"
+                f"provider: {resource.get('provider', '')}\n"
+            )
+            instance_metadata = dict(base_metadata, instance=instance_address, region=instance_region(instance))
+            dropped = {field: instance[field] for field in DROPPED_INSTANCE_FIELDS if field in instance}
+            first = True
+            for text in self.pack_lines(header, self.attribute_lines(instance.get("attributes"))):
+                chunk_metadata = dict(instance_metadata)
+                if first:
+                    # Dropped fields are attached once per instance rather than copied onto every chunk
+                    if "dependencies" in dropped:
+                        chunk_metadata["dependencies"] = dropped["dependencies"]
+                    if "sensitive_attributes" in dropped:
+                        chunk_metadata["sensitive_attributes"] = json.dumps(dropped["sensitive_attributes"])
+                    if "private" in dropped:
+                        chunk_metadata["private"] = dropped["private"]
+                    first = False
+                self.chunks += 1
+                self.tokens += count_tokens(text)
+                yield Document(page_content=text, metadata=chunk_metadata)
+
+    def pack_lines(self, header, lines):
+        # Greedily fill chunks with whole attribute lines, every chunk repeats the resource header
+        budget = max(self.chunk_size - len(header), self.chunk_size // 2)
+        current = []
+        size = 0
+        emitted = False
+        for line in lines:
+            while len(line) > budget:
+                # A single oversized value is cut into pieces rather than dropped
+                if current:
+                    yield header + "\n".join(current)
+                    current, size = [], 0
+                yield header + line[:budget]
+                emitted = True
+                line = line[budget:]
+            if size + len(line) + 1 > budget and current:
+                yield header + "\n".join(current)
+                emitted = True
+                current, size = [], 0
+            current.append(line)
+            size += len(line) + 1
+        if current or not emitted:
+            yield header + "\n".join(current)
@@ -0,0 +1,25 @@
+import threading
+
+
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+def get_encoding():
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                # tiktoken is missing or could not fetch its vocabulary, fall back to an estimate
+                print(f"Unable to load tiktoken, estimating token counts: {e}")
+                _encoding = False
+        return _encoding
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if not encoding:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+from modules.resource_index import ResourceIndex
+from modules.state_inventory import StateInventory
+from modules.vector_store import estimate_store_bytes
+
+
+
+def index_key(source, record):
+    # A GCS generation identifies one exact version of the state content
+    return f"{source}@{record.get('generation')}"
+
+
+class RegistryEntry():
+    def __init__(self, key, source, store, record):
+        self.key = key
+        self.source = source
+        self.store = store
+        self.record = record
+        self.size = estimate_store_bytes(store)
+        # Published stores are never modified, so the metadata index is built once per entry
+        self.resource_index = ResourceIndex.from_store(store)
+        # Counts, addresses and dependencies of every resource, None for indexes written before the inventory existed
+        self.inventory = StateInventory.from_dict(record.get("inventory"))
+        # session id -> last time that session used this entry
+        self.sessions = {}
+        self.last_used = time.time()
+
+
+class VectorStoreRegistry():
+    def __init__(self, memory_budget, idle_seconds):
+        self.memory_budget = memory_budget
+        self.idle_seconds = idle_seconds
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, session_id=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.last_used = time.time()
+                if session_id in entry.sessions:
+                    entry.sessions[session_id] = entry.last_used
+            return entry
+
+    def latest(self, source):
+        with self.lock:
+            entries = [entry for entry in self.entries.values() if entry.source == source]
+            if not entries:
+                return None
+            return max(entries, key=lambda entry: entry.record.get("generation") or 0)
+
+    def put(self, key, source, store, record, session_id=None):
+        with self.lock:
+            entry = self.entries.get(key)
+        # Building an entry walks every chunk, so it is done without holding the lock
+        new_entry = RegistryEntry(key, source, store, record) if entry is None else None
+        with self.lock:
+            # Sessions that indexed the same state at the same time share the first published copy
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = new_entry or RegistryEntry(key, source, store, record)
+                self.entries[key] = entry
+                print(f"Registered index {key} ({entry.size / 1e6:.1f} MB)")
+            entry.last_used = time.time()
+            if session_id is not None:
+                entry.sessions[session_id] = entry.last_used
+            self.evict()
+            return entry
+
+    def acquire(self, key, session_id):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry.last_used = time.time()
+            entry.sessions[session_id] = entry.last_used
+            return entry
+
+    def release(self, key, session_id):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.sessions.pop(session_id, None)
+            self.evict()
+
+    def evict(self):
+        # Called with the lock held. Drops least recently used entries nobody holds until under budget
+        total = sum(entry.size for entry in self.entries.values())
+        if total <= self.memory_budget:
+            return
+        now = time.time()
+        for entry in sorted(self.entries.values(), key=lambda entry: entry.last_used):
+            if total <= self.memory_budget:
+                break
+            # Sessions that closed their browser tab never release, so idle references expire
+            entry.sessions = {
+                session_id: last_used for session_id, last_used in entry.sessions.items()
+                if now - last_used < self.idle_seconds
+            }
+            if not entry.sessions:
+                del self.entries[entry.key]
+                total -= entry.size
+                print(f"Evicted index {entry.key} ({entry.size / 1e6:.1f} MB)")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": sum(entry.size for entry in self.entries.values()),
+                "references": sum(len(entry.sessions) for entry in self.entries.values()),
+            }
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry():
+    # One registry per process so sessions loading the same state share its index
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = VectorStoreRegistry(
+                memory_budget=int(os.getenv("VECTOR_STORE_MEMORY_MB", "2048")) * 1024 * 1024,
+                idle_seconds=int(os.getenv("VECTOR_STORE_IDLE_SECONDS", "3600")),
+            )
+        return _registry
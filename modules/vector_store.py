@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import numpy as np
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.schema import Document
+from langchain.vectorstores import DocArrayInMemorySearch, FAISS
+from langchain.vectorstores.faiss import dependable_faiss_import
+from modules.telemetry import get_telemetry
+
+
+
+def new_faiss_index(dimension):
+    faiss = dependable_faiss_import()
+    index_type = os.getenv("FAISS_INDEX_TYPE", "hnsw")
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, int(os.getenv("FAISS_HNSW_M", "32")))
+        index.hnsw.efSearch = int(os.getenv("FAISS_HNSW_EF_SEARCH", "64"))
+        return index
+    elif index_type == "flat":
+        return faiss.IndexFlatL2(dimension)
+    raise ValueError(f"Unknown FAISS index type: {index_type}")
+
+def create_vector_store(embedding_function):
+    backend = os.getenv("VECTOR_STORE", "memory")
+    print(f"Vector store backend: {backend}")
+    if backend == "faiss":
+        # The FAISS index is created on the first add, once the embedding dimension is known
+        return FAISS(embedding_function, None, InMemoryDocstore(), {})
+    elif backend == "memory":
+        return DocArrayInMemorySearch.from_params(embedding=embedding_function)
+    raise ValueError(f"Unknown vector store backend: {backend}")
+
+def add_documents(store, docs):
+    if isinstance(store, FAISS):
+        telemetry = get_telemetry()
+        texts = [doc.page_content for doc in docs]
+        with telemetry.span("embed", texts=len(texts)):
+            embeddings = store.embedding_function.embed_documents(texts)
+        with telemetry.span("vector_add", vectors=len(embeddings)):
+            if store.index is None:
+                store.index = new_faiss_index(len(embeddings[0]))
+            return store.add_embeddings(list(zip(texts, embeddings)), [doc.metadata for doc in docs])
+    return store.add_documents(docs)
+
+def delete_documents(store, ids):
+    if isinstance(store, FAISS):
+        try:
+            store.delete(ids)
+        except RuntimeError:
+            # HNSW indexes do not support remove_ids, rebuild them from the remaining vectors
+            rebuild_faiss_index(store, ids)
+    else:
+        try:
+            store.delete(ids)
+        except NotImplementedError:
+            # DocArrayInMemorySearch has no delete, remove the vectors from the docarray index directly
+            del store.doc_index[ids]
+
+def rebuild_faiss_index(store, ids):
+    deleted = set(ids)
+    keep = [(position, doc_id) for position, doc_id in sorted(store.index_to_docstore_id.items()) if doc_id not in deleted]
+    index = new_faiss_index(store.index.d)
+    if keep:
+        vectors = np.vstack([store.index.reconstruct(position) for position, _ in keep])
+        index.add(vectors)
+    store.index = index
+    store.docstore.delete(list(deleted))
+    store.index_to_docstore_id = {position: doc_id for position, (_, doc_id) in enumerate(keep)}
+
+def clone_vector_store(store):
+    # Published stores are shared read-only between sessions, so updates are applied to a copy
+    if isinstance(store, FAISS):
+        faiss = dependable_faiss_import()
+        index = faiss.clone_index(store.index) if store.index is not None else None
+        return FAISS(store.embedding_function, index, InMemoryDocstore(dict(store.docstore._dict)), dict(store.index_to_docstore_id))
+    clone = DocArrayInMemorySearch.from_params(embedding=store.embedding)
+    clone.doc_index.index([
+        clone.doc_cls(id=doc.id, text=doc.text, embedding=doc.embedding, metadata=doc.metadata)
+        for doc in store.doc_index._docs
+    ])
+    return clone
+
+def merge_vector_stores(stores, workspaces, embedding_function):
+    # Copies the vectors of several states into one store without re-embedding them
+    # Every chunk is tagged with its workspace, in the metadata for filtering and in the text for the LLM
+    docs = []
+    vectors = []
+    for store, workspace in zip(stores, workspaces):
+        items = list(iter_documents(store))
+        if not items:
+            continue
+        vectors.append(vectors_at(store, [position for _, position, _ in items]))
+        for doc_id, _, doc in items:
+            docs.append((doc_id, Document(
+                page_content=f"workspace: {workspace}\n{doc.page_content}",
+                metadata=dict(doc.metadata, workspace=workspace),
+            )))
+    merged = create_vector_store(embedding_function)
+    if not docs:
+        return merged
+    matrix = np.vstack(vectors).astype("float32")
+    if isinstance(merged, FAISS):
+        merged.index = new_faiss_index(matrix.shape[1])
+        merged.index.add(matrix)
+        merged.docstore = InMemoryDocstore(dict(docs))
+        merged.index_to_docstore_id = {position: doc_id for position, (doc_id, _) in enumerate(docs)}
+    else:
+        merged.doc_index.index([
+            merged.doc_cls(id=doc_id, text=doc.page_content, embedding=vector, metadata=doc.metadata)
+            for (doc_id, doc), vector in zip(docs, matrix)
+        ])
+    return merged
+
+def iter_documents(store):
+    # Yields (doc id, position, document), the position is what vectors_at and document_at take
+    if isinstance(store, FAISS):
+        for position, doc_id in store.index_to_docstore_id.items():
+            yield doc_id, position, store.docstore._dict[doc_id]
+    else:
+        for position, doc in enumerate(store.doc_index._docs):
+            yield doc.id, position, Document(page_content=doc.text, metadata=doc.metadata)
+
+def document_at(store, doc_id, position):
+    if isinstance(store, FAISS):
+        return store.docstore._dict[doc_id]
+    doc = store.doc_index._docs[position]
+    return Document(page_content=doc.text, metadata=doc.metadata)
+
+def vectors_at(store, positions):
+    if isinstance(store, FAISS):
+        return store.index.reconstruct_batch(np.asarray(positions, dtype="int64"))
+    return np.vstack([np.asarray(store.doc_index._docs[position].embedding, dtype="float32") for position in positions])
+
+def search_ids(store, embedding, k):
+    # Approximate nearest neighbours over the whole store, best match first
+    if isinstance(store, FAISS):
+        if store.index is None:
+            return []
+        _, positions = store.index.search(np.asarray([embedding], dtype="float32"), k)
+        return [store.index_to_docstore_id[position] for position in positions[0] if position != -1]
+    result = store.doc_index.find(np.asarray(embedding, dtype="float32"), search_field="embedding", limit=k)
+    return [doc.id for doc in result.documents]
+
+def estimate_store_bytes(store):
+    if isinstance(store, FAISS):
+        if store.index is None:
+            return 0
+        text_bytes = sum(len(doc.page_content) for doc in store.docstore._dict.values())
+        return store.index.ntotal * store.index.d * 4 + text_bytes
+    return sum(doc.embedding.nbytes + len(doc.text) for doc in store.doc_index._docs)
+
+def index_dir(source):
+    root = os.getenv("VECTOR_STORE_PATH", ".cache/indexes")
+    return os.path.join(root, hashlib.sha256(source.encode("utf-8")).hexdigest()[:32])
+
+# Held while the files of a saved index are swapped in, so two saves of one source never mix their files
+_save_lock = threading.Lock()
+
+def save_vector_store(store, source, record):
+    # Only the FAISS backend is persisted, the in-memory store is rebuilt on restart
+    if not isinstance(store, FAISS) or store.index is None:
+        return
+    faiss = dependable_faiss_import()
+    path = index_dir(source)
+    os.makedirs(path, exist_ok=True)
+    # Write to a directory of its own first so a crash or a concurrent save never leaves a half written index behind
+    staging = tempfile.mkdtemp(dir=path, prefix=".save-")
+    try:
+        faiss.write_index(store.index, os.path.join(staging, "index.faiss"))
+        with open(os.path.join(staging, "index.pkl"), "wb") as f:
+            pickle.dump((store.docstore, store.index_to_docstore_id), f)
+        with open(os.path.join(staging, "manifest.json"), "w") as f:
+            json.dump({"source": source, "record": record}, f)
+        with _save_lock:
+            # The manifest goes last, a reader that finds it finds the index and docstore it describes
+            for name in ("index.faiss", "index.pkl", "manifest.json"):
+                os.replace(os.path.join(staging, name), os.path.join(path, name))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    print(f"Saved index for {source} to {path}")
+
+def load_vector_store(source, embedding_function):
+    path = index_dir(source)
+    if os.getenv("VECTOR_STORE", "memory") != "faiss" or not os.path.exists(os.path.join(path, "manifest.json")):
+        return None, None
+    faiss = dependable_faiss_import()
+    # HNSW and flat indexes are read fully into memory, faiss can only memory-map the inverted lists of IVF indexes
+    index = faiss.read_index(os.path.join(path, "index.faiss"))
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = int(os.getenv("FAISS_HNSW_EF_SEARCH", "64"))
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    with open(os.path.join(path, "manifest.json")) as f:
+        record = json.load(f)["record"]
+    print(f"Loaded index for {source} from {path}")
+    return FAISS(embedding_function, index, docstore, index_to_docstore_id), record
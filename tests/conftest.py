@@ -0,0 +1,7 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The app modules are imported as modules.*, the workflow scripts import each other by file name
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, ".github", "scripts"))
@@ -0,0 +1,187 @@
+import http.server
+import json
+import re
+import threading
+import urllib.parse
+
+import pytest
+import requests
+
+import github_details
+
+PAGE_SIZE = 3
+
+
+def push_event(event_id):
+    return {
+        "id": str(event_id), "type": "PushEvent", "actor": {"login": "octocat"}, "repo": {"name": "org/repo"},
+        "public": True, "created_at": "2024-01-01T00:00:00Z",
+        "payload": {"commits": [{"author": {"name": "octocat"}, "message": f"commit {event_id}", "url": "url"}]},
+    }
+
+
+def summarize_commits(message, event_type):
+    return re.search(r"commit \d+", message).group()
+
+
+class FakeGitHub(http.server.ThreadingHTTPServer):
+    # Serves /repos/org/repo/events newest first in pages of PAGE_SIZE with an ETag and Link header, and records chat posts
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeGitHubHandler)
+        self.events = []
+        self.requests = []
+        self.messages = []
+        self.failing_page = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    @property
+    def event_requests(self):
+        return [path for path in self.requests if "/events" in path]
+
+
+class FakeGitHubHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.path)
+        page = int(urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query).get("page", ["1"])[0])
+        if page == server.failing_page:
+            self.send_response(502)
+            self.end_headers()
+            return
+        etag = f'"{len(server.events)}"'
+        if page == 1 and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        newest_first = sorted(server.events, key=lambda event: -int(event["id"]))
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        if page * PAGE_SIZE < len(newest_first):
+            self.send_header("Link", f'<{server.url}/repos/org/repo/events?per_page=100&page={page + 1}>; rel="next"')
+        self.end_headers()
+        self.wfile.write(json.dumps(newest_first[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]).encode())
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.messages.append(json.loads(body)["text"])
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def github(monkeypatch):
+    server = FakeGitHub()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("GITHUB_REPOSITORY", "org/repo")
+    monkeypatch.setenv("GITHUB_TOKEN", "token")
+    monkeypatch.setattr(github_details, "GITHUB_API_URL", server.url)
+    monkeypatch.setattr(github_details, "pushevent_ask", summarize_commits)
+    monkeypatch.setattr(github_details, "stage_timings", {})
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def state_path(tmp_path):
+    return str(tmp_path / "events.json")
+
+
+def run_batch(github, state_path):
+    github.requests.clear()
+    github.messages.clear()
+    github_details.process_events_batch(f"{github.url}/chat", state_path)
+    return github_details.load_events_state(state_path)
+
+
+def test_first_run_posts_only_the_latest_event(github, state_path):
+    github.events = [push_event(i) for i in range(1, 5)]
+    state = run_batch(github, state_path)
+    assert github.messages == ["commit 4"]
+    assert state == {"last_event_id": "4", "etag": '"4"'}
+
+
+def test_unchanged_events_answer_304(github, state_path):
+    github.events = [push_event(i) for i in range(1, 5)]
+    run_batch(github, state_path)
+    state = run_batch(github, state_path)
+    assert github.messages == []
+    assert len(github.event_requests) == 1
+    assert state == {"last_event_id": "4", "etag": '"4"'}
+
+
+def test_new_events_are_paged_until_the_cursor_and_posted_in_order(github, state_path):
+    github.events = [push_event(i) for i in range(1, 5)]
+    run_batch(github, state_path)
+    github.events += [push_event(i) for i in range(5, 12)]
+    state = run_batch(github, state_path)
+    assert github.messages == [f"commit {i}" for i in range(5, 12)]
+    # 11 events newest first, event 4 is on the third page
+    assert len(github.event_requests) == 3
+    assert state == {"last_event_id": "11", "etag": '"11"'}
+
+
+def test_failed_page_leaves_the_state_unchanged(github, state_path):
+    github.events = [push_event(i) for i in range(1, 5)]
+    saved = run_batch(github, state_path)
+    github.events += [push_event(i) for i in range(5, 12)]
+    github.failing_page = 2
+    assert run_batch(github, state_path) == saved
+    assert github.messages == []
+    github.failing_page = None
+    assert run_batch(github, state_path)["last_event_id"] == "11"
+    assert len(github.messages) == 7
+
+
+def test_network_error_leaves_the_state_unchanged(github, state_path, monkeypatch):
+    github.events = [push_event(i) for i in range(1, 5)]
+    saved = run_batch(github, state_path)
+    github.events.append(push_event(5))
+
+    def unreachable(*args, **kwargs):
+        raise requests.ConnectionError("connection refused")
+
+    monkeypatch.setattr(github_details.get_session(), "get", unreachable)
+    assert run_batch(github, state_path) == saved
+    assert github.messages == []
+
+
+def test_failed_summary_keeps_the_cursor_before_it_and_drops_the_etag(github, state_path, monkeypatch):
+    github.events = [push_event(i) for i in range(1, 5)]
+    run_batch(github, state_path)
+    github.events += [push_event(i) for i in range(5, 9)]
+
+    def flaky(message, event_type):
+        if "commit 7" in message:
+            raise RuntimeError("model unavailable")
+        return summarize_commits(message, event_type)
+
+    monkeypatch.setattr(github_details, "pushevent_ask", flaky)
+    state = run_batch(github, state_path)
+    assert github.messages == ["commit 5", "commit 6"]
+    assert state == {"last_event_id": "6"}
+    # Without the ETag the next run fetches the remaining events again
+    monkeypatch.setattr(github_details, "pushevent_ask", summarize_commits)
+    state = run_batch(github, state_path)
+    assert github.messages == ["commit 7", "commit 8"]
+    assert state == {"last_event_id": "8", "etag": '"8"'}
+
+
+def test_timings_of_concurrent_events_are_kept_apart(github, state_path, monkeypatch):
+    def summarize_event(event):
+        with github_details.timed("event_summary"):
+            return f"summary {event['id']}"
+
+    github.events = [push_event(i) for i in range(1, 3)]
+    run_batch(github, state_path)
+    github.events += [push_event(i) for i in range(3, 7)]
+    monkeypatch.setattr(github_details, "summarize_event", summarize_event)
+    run_batch(github, state_path)
+    assert {f"event {i}/event_summary" for i in range(3, 7)} <= set(github_details.stage_timings)
@@ -0,0 +1,102 @@
+import json
+import threading
+
+import pytest
+
+import patch_summarizer
+
+
+def patch_of(files):
+    return "".join(
+        f"diff --git a/f{i}.py b/f{i}.py\n--- a/f{i}.py\n+++ b/f{i}.py\n@@ -1,1 +1,1 @@\n-old {i}\n+new {i}\n"
+        for i in range(files)
+    )
+
+
+class FakeResponse():
+    status_code = 200
+    encoding = "utf-8"
+
+    def __init__(self, text):
+        self.text = text
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_lines(self, decode_unicode=True):
+        return iter(self.text.splitlines())
+
+
+class FakeSession():
+    def __init__(self, text):
+        self.text = text
+
+    def get(self, *args, **kwargs):
+        return FakeResponse(self.text)
+
+
+class FakeLLM():
+    def __init__(self, summary, numbered=False, max_calls=100):
+        self.summary = summary
+        # Numbered summaries all differ, so no reduce is answered from the cache
+        self.numbered = numbered
+        self.max_calls = max_calls
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def predict(self, prompt):
+        with self.lock:
+            self.calls += 1
+            # A reduce loop that never shrinks would otherwise hang the test
+            if self.calls > self.max_calls:
+                raise RuntimeError("too many LLM calls")
+            return f"{self.summary} {self.calls}" if self.numbered else self.summary
+
+
+@pytest.fixture
+def cache_path(monkeypatch, tmp_path):
+    path = str(tmp_path / "patch-summaries.json")
+    monkeypatch.setenv("PATCH_SUMMARY_CACHE", path)
+    return path
+
+
+@pytest.mark.parametrize("files", [2, 3, 7])
+def test_reduce_terminates_when_summaries_exceed_the_unit(cache_path, monkeypatch, files):
+    # Every summary is longer than a whole reduce unit, the worst case for the reduce loop
+    monkeypatch.setenv("PATCH_UNIT_TOKENS", "50")
+    llm = FakeLLM(" ".join(["long summary"] * 100), numbered=True)
+    summary = patch_summarizer.summarize_patch(llm, FakeSession(patch_of(files)), "patch-url", 5)
+    assert summary == f"{llm.summary} {llm.calls}"
+    # One map call per file, and every reduce call combines at least two summaries
+    assert llm.calls == 2 * files - 1
+
+
+def test_single_file_is_not_reduced(cache_path):
+    llm = FakeLLM("short summary")
+    assert patch_summarizer.summarize_patch(llm, FakeSession(patch_of(1)), "patch-url", 5) == "f0.py:\nshort summary"
+    assert llm.calls == 1
+
+
+def test_summaries_are_cached_between_runs(cache_path):
+    first = FakeLLM("short summary")
+    patch_summarizer.summarize_patch(first, FakeSession(patch_of(4)), "patch-url", 5)
+    second = FakeLLM("other summary")
+    assert patch_summarizer.summarize_patch(second, FakeSession(patch_of(4)), "patch-url", 5) == "short summary"
+    assert second.calls == 0
+    with open(cache_path) as f:
+        assert len(json.load(f)) == first.calls
+
+
+def test_concurrent_cache_saves_keep_every_entry(cache_path):
+    threads = [
+        threading.Thread(target=patch_summarizer.save_cache, args=(cache_path, {f"key-{i}": f"summary {i}"}, 100))
+        for i in range(20)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert patch_summarizer.load_cache(cache_path) == {f"key-{i}": f"summary {i}" for i in range(20)}
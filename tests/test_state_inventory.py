@@ -0,0 +1,101 @@
+import pytest
+from langchain.schema import Document
+
+from modules.resource_index import ResourceIndex
+from modules.state_inventory import StateInventory
+
+PROVIDER = 'provider["registry.terraform.io/hashicorp/google"]'
+RESOURCES = [
+    ("google_compute_network", "vpc", "", {"name": "vpc"}, []),
+    ("google_compute_instance", "web", "", {"zone": "us-central1-a"}, ["google_compute_network.vpc"]),
+    ("google_compute_instance", "worker", "", {"zone": "europe-west1-b"}, ["google_compute_network.vpc"]),
+    ("google_storage_bucket", "logs", "", {"location": "US-CENTRAL1"}, []),
+    ("google_storage_bucket", "assets", "module.network", {"location": "EU"}, []),
+]
+
+
+def address(resource_type, name, module):
+    return f"{module}.{resource_type}.{name}" if module else f"{resource_type}.{name}"
+
+
+def build_index(inventory):
+    # The retrieval index of a state has one chunk per resource here, carrying the same metadata
+    index = ResourceIndex()
+    for position, entry in enumerate(inventory.resources.values()):
+        metadata = {field: entry[field] for field in ("resource_type", "resource_name", "module", "provider", "region", "address", "workspace")}
+        index.add(str(position), position, Document(page_content=entry["address"], metadata=metadata))
+    return index
+
+
+@pytest.fixture(scope="module")
+def state():
+    inventory = StateInventory()
+    for resource_type, name, module, attributes, dependencies in RESOURCES:
+        resource = {"mode": "managed", "type": resource_type, "name": name, "provider": PROVIDER,
+                    "instances": [{"attributes": attributes, "dependencies": dependencies}]}
+        if module:
+            resource["module"] = module
+        inventory.add(resource, address(resource_type, name, module))
+    return inventory, build_index(inventory)
+
+
+def answer(state, question):
+    inventory, index = state
+    return inventory.answer(question, index)
+
+
+@pytest.mark.parametrize("question, expected", [
+    ("How many compute instances are there?", "There are 2 resources of type google_compute_instance (2 instances)."),
+    ("How many buckets are in us-central1?", "There is 1 resource of type google_storage_bucket, in region us-central1 (1 instance)."),
+    ("list the buckets in module network", "1 resource of type google_storage_bucket, in module.network:\n- module.network.google_storage_bucket.assets (eu)"),
+    ("how many resources are there", "There are 5 resources (5 instances).\n- google_compute_instance: 2\n- google_storage_bucket: 2\n- google_compute_network: 1"),
+    ("What does google_compute_instance.web depend on?", "google_compute_instance.web depends on 1 resource:\n- google_compute_network.vpc"),
+    ("What depends on google_compute_network.vpc?", "2 resources depend on google_compute_network.vpc:\n- google_compute_instance.web\n- google_compute_instance.worker"),
+    ("What depends on google_compute_instance.web?", "0 resources depend on google_compute_instance.web."),
+])
+def test_answers_from_the_inventory(state, question, expected):
+    assert answer(state, question) == expected
+
+
+@pytest.mark.parametrize("question", [
+    # Single resource questions other than dependencies need its attributes
+    "What is google_storage_bucket.logs?",
+    "show google_storage_bucket.logs",
+    "What region is google_storage_bucket.logs in?",
+    "How many instances does google_compute_instance.web have?",
+    # Nothing to count or list
+    "What regions are there?",
+    "how many are in us-central1?",
+    # Words no filter accounts for
+    "How many nodes are in my GKE cluster?",
+    "count the buckets with versioning enabled",
+    "Which service account does my worker VM run as? show all details",
+    # Asks for code or an explanation
+    "Write terraform code for a compute instance",
+    "Explain why there are 2 compute instances",
+])
+def test_leaves_other_questions_to_the_llm(state, question):
+    assert answer(state, question) is None
+
+
+def test_summary(state):
+    inventory, _ = state
+    assert inventory.summary().splitlines()[0] == "5 resources with 5 instances."
+
+
+def test_round_trip_rebuilds_dependents(state):
+    inventory, index = state
+    loaded = StateInventory.from_dict(inventory.to_dict())
+    assert loaded.dependents == inventory.dependents
+    assert loaded.answer("What depends on google_compute_network.vpc?", index) == answer(state, "What depends on google_compute_network.vpc?")
+
+
+def test_combined_inventory_needs_a_workspace(state):
+    inventory, _ = state
+    combined = StateInventory.combine([("prod/default", inventory), ("staging/default", inventory)])
+    index = build_index(combined)
+    assert combined.answer("How many compute instances are there?", index) is None
+    assert combined.answer("How many compute instances are in the prod workspace?", index) == \
+        "There are 2 resources of type google_compute_instance, in workspace prod/default (2 instances)."
+    assert combined.answer("What depends on google_compute_network.vpc in the staging workspace?", index) == \
+        "[staging/default] 2 resources depend on google_compute_network.vpc:\n- google_compute_instance.web\n- google_compute_instance.worker"
@@ -0,0 +1,75 @@
+import os
+import threading
+
+import pytest
+from langchain.schema import Document
+
+from modules.vector_store import add_documents, create_vector_store, index_dir, load_vector_store, save_vector_store
+
+pytest.importorskip("faiss")
+
+SOURCE = "gs://bucket/prod.tfstate"
+
+
+class CountEmbeddings():
+    # The vector only has to be stable, search quality does not matter here
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return [float(len(text)), float(sum(map(ord, text)) % 97), 1.0, 0.0]
+
+
+@pytest.fixture
+def faiss_store(monkeypatch, tmp_path):
+    monkeypatch.setenv("VECTOR_STORE", "faiss")
+    monkeypatch.setenv("VECTOR_STORE_PATH", str(tmp_path))
+
+    def build(count):
+        store = create_vector_store(CountEmbeddings())
+        add_documents(store, [Document(page_content=f"resource {i}", metadata={"position": i}) for i in range(count)])
+        return store
+
+    return build
+
+
+def test_saved_index_loads_back(faiss_store):
+    save_vector_store(faiss_store(10), SOURCE, {"generation": 1})
+    store, record = load_vector_store(SOURCE, CountEmbeddings())
+    assert record == {"generation": 1}
+    assert store.index.ntotal == 10
+    assert len(store.docstore._dict) == 10
+    assert sorted(os.listdir(index_dir(SOURCE))) == ["index.faiss", "index.pkl", "manifest.json"]
+
+
+def test_concurrent_saves_never_mix_their_files(faiss_store):
+    stores = [(size, faiss_store(size)) for size in (5, 20, 40, 80)]
+    threads = [
+        threading.Thread(target=save_vector_store, args=(store, SOURCE, {"generation": size, "size": size}))
+        for size, store in stores * 3
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    store, record = load_vector_store(SOURCE, CountEmbeddings())
+    # Whichever save finished last, the index, docstore and manifest all come from it
+    assert store.index.ntotal == record["size"]
+    assert len(store.docstore._dict) == record["size"]
+    assert len(store.index_to_docstore_id) == record["size"]
+    assert sorted(os.listdir(index_dir(SOURCE))) == ["index.faiss", "index.pkl", "manifest.json"]
+
+
+def test_failed_save_keeps_the_previous_index(faiss_store, monkeypatch):
+    save_vector_store(faiss_store(10), SOURCE, {"generation": 1})
+
+    def broken_dump(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr("modules.vector_store.pickle.dump", broken_dump)
+    with pytest.raises(OSError):
+        save_vector_store(faiss_store(30), SOURCE, {"generation": 2})
+    store, record = load_vector_store(SOURCE, CountEmbeddings())
+    assert record == {"generation": 1}
+    assert store.index.ntotal == 10
+    assert sorted(os.listdir(index_dir(SOURCE))) == ["index.faiss", "index.pkl", "manifest.json"]